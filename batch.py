@@ -0,0 +1,198 @@
+import numpy as np
+
+from settings import settings
+from engine import PongEngine
+
+
+# same rules as engine.PongEngine, but for n games at once held as struct-of-arrays buffers
+# speeds may be scalars or arrays of length n, so whole grids of settings can be tried in one run
+class BatchEngine:
+    def __init__(
+        self, n, width=4 / 3, speed=None, speedup=None, move_speed=None, bot_move_speed=None, rounds_to_win=None,
+        bot_reaction=None, bot_error=None, seed=None,
+    ):
+        self.n = n
+        self.width = width
+        self.rng = np.random.default_rng(seed)
+
+        def column(value, default, dtype=np.float64):
+            return np.broadcast_to(np.asarray(default if value is None else value, dtype=dtype), (n,)).copy()
+
+        self.speed = column(speed, settings.speed)
+        self.speedup = column(speedup, settings.speedup)
+        self.move_speed = column(move_speed, settings.moveSpeed) # player2
+        self.bot_move_speed = column(bot_move_speed, settings.botMoveSpeed) # player1
+        self.rounds_to_win = column(rounds_to_win, settings.rounds_to_win, np.int32)
+        self.bot_reaction = np.rint(column(bot_reaction, settings.bot_reaction) * settings.fps).astype(np.int64) # in ticks
+        self.bot_error = column(bot_error, settings.bot_error)
+
+        self.paddle_width = PongEngine.paddle_width * width
+        self.paddle_height = PongEngine.paddle_height
+        self.ball_size = PongEngine.ball_size
+        self.x1 = self.paddle_width / 2 # player1 (left) x
+        self.x2 = width - self.paddle_width * 1.5 # player2 (right) x
+
+        self.ball = np.zeros((4, n)) # x, y, velocity_x, velocity_y
+        self.paddles = np.zeros((2, n)) # player1 y, player2 y
+        self.scores = np.zeros((2, n), dtype=np.int32)
+        self.streak = np.zeros(n, dtype=np.int32)
+        self.ticks = np.zeros(n, dtype=np.int64) # ticks since the match started
+        self.clock = 0 # ticks since creation, for bots' reaction delay
+
+        # bot.Bot's state for both sides
+        self.bot_velocity = np.full((2, 2, n), np.nan) # ball velocity x and |y| the prediction was made for
+        self.bot_target = np.full((2, n), 0.5)
+        self.bot_pending = np.full((2, n), 0.5)
+        self.bot_react_at = np.zeros((2, n), dtype=np.int64)
+
+    def reset(self):
+        self.scores[:] = 0
+        self.streak[:] = 0
+        self.ticks[:] = 0
+        self.serve(np.ones(self.n, dtype=bool), self.rng.choice([-1, 1], self.n))
+        return self.observe()
+
+    def serve(self, mask, direction): # serve again in games selected by mask, direction is 1 (right) or -1 (left)
+        count = int(np.count_nonzero(mask))
+        if not count:
+            return
+        angle = np.radians(self.rng.integers(-60, 61, count))
+        speed = direction * self.speed[mask]
+        self.ball[0, mask] = (self.width - self.ball_size) / 2
+        self.ball[1, mask] = (1 - self.ball_size) / 2
+        self.ball[2, mask] = speed * np.cos(angle)
+        self.ball[3, mask] = speed * np.sin(angle)
+        self.paddles[:, mask] = (1 - self.paddle_height) / 2
+        self.streak[mask] = 0
+        self.bot_velocity[:, :, mask] = np.nan
+        self.bot_target[:, mask] = self.bot_pending[:, mask] = 0.5
+        self.bot_react_at[:, mask] = 0
+
+    def intercept(self, idx): # vectorized bot.Bot.intercept for player idx (0 or 1), nan where ball goes away
+        x, y, velocity_x, velocity_y = self.ball
+        size = self.ball_size
+        if idx == 0:
+            distance, approaching = x - self.x1 - self.paddle_width, velocity_x < 0
+        else:
+            distance, approaching = self.x2 - x - size, velocity_x > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            y = y + velocity_y * distance / np.abs(velocity_x)
+        span = 1 - size
+        y = np.mod(y, 2 * span)
+        y = np.where(y > span, 2 * span - y, y)
+        return np.where(approaching & (distance >= 0), y + size / 2, np.nan)
+
+    def bot_inputs(self, idx): # vectorized bot.Bot.move for player idx (0 or 1)
+        velocity = np.stack([self.ball[2], np.abs(self.ball[3])])
+        changed = np.any(velocity != self.bot_velocity[idx], axis=0)
+        if changed.any():
+            self.bot_velocity[idx][:, changed] = velocity[:, changed]
+            target = self.intercept(idx)[changed]
+            error = self.rng.uniform(-1, 1, target.size) * self.bot_error[changed]
+            self.bot_pending[idx, changed] = np.where(np.isnan(target), 0.5, target + error)
+            self.bot_react_at[idx, changed] = self.clock + self.bot_reaction[changed]
+        ready = self.clock >= self.bot_react_at[idx]
+        target = self.bot_target[idx] = np.where(ready, self.bot_pending[idx], self.bot_target[idx])
+
+        center = self.paddles[idx] + self.paddle_height / 2
+        half_speed = (self.bot_move_speed, self.move_speed)[idx] / 2
+        up = target > center + half_speed
+        down = target < center - half_speed
+        return up.astype(np.int8) - down.astype(np.int8)
+
+    # vectorized PongEngine.impact, target is 0 for nothing, 1 for a wall, 2 for player1 and 3 for player2
+    def impact(self, remaining):
+        x, y, velocity_x, velocity_y = self.ball
+        size = self.ball_size
+        time = remaining.copy()
+        target = np.zeros(self.n, dtype=np.int8)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            wall = np.where(velocity_y > 0, (1 - size - y) / velocity_y, np.where(velocity_y < 0, -y / velocity_y, np.inf))
+            wall = np.maximum(wall, 0)
+            target[wall < time] = 1
+            time = np.minimum(time, wall)
+
+            faces = [ # paddle x, approaching, time when ball's leading side reaches paddle's side facing the field
+                (self.x1, velocity_x < 0, (self.x1 + self.paddle_width - x) / velocity_x),
+                (self.x2, velocity_x > 0, (self.x2 - x - size) / velocity_x),
+            ]
+        for idx, (paddle_x, approaching, hit) in enumerate(faces):
+            paddle_y = self.paddles[idx]
+            overlap = ( # paddle moved onto the ball
+                (x + size >= paddle_x) & (x <= paddle_x + self.paddle_width)
+                & (y + size >= paddle_y) & (y <= paddle_y + self.paddle_height)
+            )
+            hit_y = y + velocity_y * hit
+            face = (hit >= 0) & (hit < time) & (hit_y <= paddle_y + self.paddle_height) & (hit_y + size >= paddle_y)
+            taken = approaching & (overlap | face)
+            time = np.where(taken, np.where(overlap, 0, hit), time)
+            target[taken] = idx + 2
+        return time, target
+
+    # inputs is an (n, 2) array of player1 and player2 move directions, None lets bots play both sides
+    # returns observations, rewards (+1 if player2 took the point, -1 if player1 did), done and winners (1 or 2, 0 if running)
+    def step(self, inputs=None):
+        if inputs is None:
+            inputs = np.stack([self.bot_inputs(0), self.bot_inputs(1)], axis=1)
+        inputs = np.asarray(inputs)
+
+        speeds = np.stack([self.bot_move_speed, self.move_speed])
+        np.clip(self.paddles + inputs.T * speeds, 0, 1 - self.paddle_height, out=self.paddles)
+
+        ball = self.ball
+        remaining = np.ones(self.n)
+        moving = np.ones(self.n, dtype=bool) # games still resolving bounces of this tick
+        for _ in range(PongEngine.max_impacts):
+            time, target = self.impact(remaining)
+            time[~moving] = 0
+            target[~moving] = 0
+            ball[0] += ball[2] * time
+            ball[1] += ball[3] * time
+            remaining -= time
+            moving &= target > 0
+
+            # bounce off top and bottom
+            ball[3] = np.where(target == 1, -ball[3], ball[3])
+            # bounce off the paddles
+            hit = target >= 2
+            ball[2] = np.where(hit, -ball[2] * self.speedup, ball[2])
+            ball[3] = np.where(hit, ball[3] * self.speedup * 1.1, ball[3])
+            self.streak += hit
+            if not moving.any():
+                break
+        else: # finish the move without bouncing, as engine does
+            ball[0] += ball[2] * remaining * moving
+            ball[1] += ball[3] * remaining * moving
+
+        # went off the side - turn ends
+        point2 = ball[0] < 0
+        point1 = ball[0] + self.ball_size > self.width
+        self.scores[0] += point1
+        self.scores[1] += point2
+        rewards = point2.astype(np.int8) - point1.astype(np.int8)
+        self.ticks += 1
+        self.clock += 1
+
+        winners = np.where(self.scores[0] >= self.rounds_to_win, 1, 0)
+        winners = np.where(self.scores[1] >= self.rounds_to_win, 2, winners)
+        done = winners > 0
+
+        # next turn starts right away, towards the player who scored (as GameScreen.turn_end), finished matches start over
+        self.serve(point1 | point2, np.where(point2, 1, -1)[point1 | point2])
+        if done.any():
+            self.scores[:, done] = 0
+            self.ticks[done] = 0
+
+        return self.observe(), rewards, done, winners
+
+    def observe(self): # (n, 6): ball center x, ball center y, ball velocity x, ball velocity y, player1 center y, player2 center y
+        half = self.ball_size / 2
+        return np.stack([
+            self.ball[0] + half,
+            self.ball[1] + half,
+            self.ball[2],
+            self.ball[3],
+            self.paddles[0] + self.paddle_height / 2,
+            self.paddles[1] + self.paddle_height / 2,
+        ], axis=1).astype(np.float32)
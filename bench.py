@@ -0,0 +1,419 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from _thread import start_new_thread
+
+from settings import settings, ALIVE
+from engine import PongEngine
+from match import Match
+from bot import Bot
+from netcode import LinkStats
+from internet import Internet
+import protocol
+
+
+# micro benchmarks of the hot paths and a loopback match between Server and Client
+# every benchmark yields (metric, value, unit, higher is better), results are compared with a committed baseline
+# python bench.py                  run all and compare with bench_baseline.json
+# python bench.py --save           run all and store them as the new baseline
+# python bench.py -k protocol      run only benchmarks with that in their name
+
+BASELINE = "bench_baseline.json"
+TOLERANCE = 0.5 # allowed slowdown before it counts as a regression
+NOISE_FLOOR = 0.5 # µs, smaller differences are timer and cache noise whatever their ratio
+NOISY = { # metric name prefix -> its own allowed slowdown, these vary more between runs than the rest
+    "internet_send_recive": 1., # socket calls, kernel's time doesn't follow the calibration loop
+    "handle_actions: client depth 1": 1.,
+    "cold_start": 1., # new processes, their start depends on page cache and scheduling more than on our imports
+}
+BENCHMARKS = [] # (name, function)
+
+
+def benchmark(function):
+    BENCHMARKS.append((function.__name__, function))
+    return function
+
+
+def timed(function, number, repeat=11): # median time of one call in µs, a single lucky or disturbed run doesn't move it
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append(time.perf_counter() - t0)
+    return sorted(times)[len(times) // 2] / number * 1e6
+
+
+def game_update(idx): # game state as Match.update gives it, with the input ack GameScreen adds
+    ball_x = (idx % 100) / 100
+    return (True, False, idx % 7, (ball_x, 0.5), 0.3 + ball_x / 10, False, 3, 0.4, False, 2, idx * 33, idx)
+
+
+def served_engine(): # engine in the middle of a round
+    engine = PongEngine()
+    engine.state.gg = True
+    engine.center_ball()
+    engine.serve(1, 30)
+    return engine
+
+
+@benchmark
+def protocol_state():
+    encoder = protocol.SnapshotEncoder()
+    link = LinkStats("bench")
+    counter = iter(range(1 << 30))
+    def encode():
+        idx = next(counter)
+        encoder.ack(encoder.seq) # client keeps up, so frames are deltas
+        return protocol.encode(protocol.STATE, [], game_update(idx), encoder, link)
+    yield "encode", timed(encode, 2000), "µs", False
+
+    frames = [encode() for _ in range(2000)]
+    def decode_all():
+        decoder = protocol.SnapshotDecoder()
+        for frame in frames:
+            protocol.decode(frame, decoder, link)
+    yield "decode", timed(decode_all, 1) / len(frames), "µs", False
+    yield "frame size", len(frames[-1]), "B", False
+
+
+@benchmark
+def protocol_input():
+    encoder, decoder = protocol.SnapshotEncoder(), protocol.SnapshotDecoder()
+    link = LinkStats("bench")
+    update = (100, (1,) * settings.input_history)
+    def encode():
+        return protocol.encode(protocol.INPUT, [("PAUSE", None)], update, decoder, link)
+    yield "encode", timed(encode, 2000), "µs", False
+    frame = encode()
+    yield "decode", timed(lambda: protocol.decode(frame, encoder, link), 2000), "µs", False
+
+
+@benchmark
+def internet_send_recive(): # json lobby packet and game frame through a real loopback socket
+    internet = Internet.__new__(Internet) # base class without a server or client thread
+    internet.type_, internet.outgoing = "bench", protocol.STATE
+    internet.reset_internet(True)
+    socket_ = internet.get_empty_socket()
+    socket_.bind(("127.0.0.1", 0))
+    address = socket_.getsockname()
+
+    def lobby():
+        internet.send(socket_, {"server_name": "bench", **ALIVE}, address)
+        internet.recive(socket_)
+    yield "lobby round", timed(lobby, 1000), "µs", False
+
+    frame = protocol.encode(protocol.STATE, [], game_update(1), internet.snapshots)
+    def game():
+        internet.send(socket_, frame, address)
+        internet.recive(socket_, protocol.SnapshotDecoder())
+    yield "frame round", timed(game, 1000), "µs", False
+    socket_.close()
+
+
+def game_host(opt): # just enough of GameScreen for EventManager to run without widgets
+    from helpers import EventManager, ActionQueue
+    from netcode import SnapshotBuffer, PaddlePredictor, InputStream
+
+    class Host(EventManager):
+        def __init__(self):
+            self.opt = opt
+            self.engine = served_engine()
+            self.actions = ActionQueue()
+            self.recorder = self.internet = None
+            self.inputs = InputStream()
+            self.interpolation = SnapshotBuffer()
+            self.predictor = PaddlePredictor()
+            self.bot = Bot(0)
+
+        def add_action(self, name, data, *dt):
+            self.actions.put(name, data)
+
+        def turn_end(self, scorer, direction):
+            self.engine.end_turn(scorer)
+            self.engine.state.gg = True
+            self.engine.serve(direction, 30)
+    return Host()
+
+
+@benchmark
+def handle_actions(): # one frame of GameScreen with that many actions waiting
+    for opt in ["server", "client"]:
+        for depth in [1, 8, 32]: # GameScreen takes at most actions_per_tick (32) actions in a frame
+            host = game_host(opt)
+            if opt == "client":
+                host.actions.coalesce("UPDATE")
+            best = float("inf")
+            for _ in range(200):
+                for idx in range(depth):
+                    host.add_action("UPDATE", (idx, (1,)) if opt == "server" else game_update(idx))
+                t0 = time.perf_counter()
+                host.handle_actions()
+                best = min(best, time.perf_counter() - t0)
+                host.actions.take()
+            yield f"{opt} depth {depth}", best * 1e6, "µs", False
+
+
+@benchmark
+def handle_game_action():
+    for opt in ["solo", "client"]:
+        host = game_host(opt)
+        yield opt, timed(host.handle_game_action, 5000), "µs", False
+
+
+@benchmark
+def match_tick(): # headless match flow of rooms.Room, countdown and the first rounds of a seeded match
+    ticks = 3000
+    def play():
+        match = Match(0)
+        match.start()
+        for _ in range(ticks):
+            match.tick()
+    rounds_to_win, settings.rounds_to_win = settings.rounds_to_win, 1 << 30 # nobody wins while it is timed
+    try:
+        yield "tick", timed(play, 1) / ticks, "µs", False
+    finally:
+        settings.rounds_to_win = rounds_to_win
+
+
+@benchmark
+def engine():
+    engine = served_engine()
+    state = engine.state
+    def bounce():
+        engine.bounce_ball(state.player2)
+        state.ball.velocity_x, state.ball.velocity_y = settings.speed, settings.speed / 2
+    yield "bounce_ball", timed(bounce, 10000), "µs", False
+
+    def step():
+        if engine.step((1, -1)):
+            engine.center_ball()
+            state.gg = True
+            engine.serve(1, 30)
+    yield "step", timed(step, 10000), "µs", False
+
+
+@benchmark
+def bot_move():
+    engine = served_engine()
+    state = engine.state
+    bot = Bot(0)
+    yield "cached path", timed(lambda: bot.move(state.player1, state), 10000), "µs", False
+
+    state.ball.velocity_x = -abs(state.ball.velocity_x) # ball comes to the bot, so the whole intercept is worked out
+    def new_path(): # ball changed direction, path is worked out again
+        bot.velocity = None
+        return bot.move(state.player1, state)
+    yield "new path", timed(new_path, 10000), "µs", False
+
+
+@benchmark
+def batch_engine():
+    from batch import BatchEngine # needs numpy
+    engine = BatchEngine(4096, seed=0)
+    engine.reset()
+    ticks = 50
+    seconds = timed(lambda: engine.step(), ticks, 3) / 1e6
+    yield "steps", engine.n / seconds, "steps/s", True
+
+
+ARP = { # arp -a of a network with 200 devices
+    "Linux": "\n".join(f"? (192.168.1.{idx}) at 00:11:22:33:44:{idx % 100:02} [ether] on wlan0" for idx in range(1, 201)),
+    "Windows": "\nInterface: 192.168.1.10 --- 0x4\n  Internet Address      Physical Address      Type\n" + "\n".join(
+        f"  192.168.1.{idx}          00-11-22-33-44-{idx % 100:02}     dynamic" for idx in range(1, 201)
+    ),
+}
+
+
+@benchmark
+def get_devices():
+    for system, data in ARP.items():
+        yield system, timed(lambda: Internet.parse_devices(data, system), 200), "µs", False
+
+
+@benchmark
+def cold_start(): # fresh interpreter importing the game modules main.py needs before kivy's window, best of a few
+    code = "import time; t = time.perf_counter(); import settings, engine, netcode, bot, recording, profiler; print(time.perf_counter() - t)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    run = lambda: subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True, check=True).stdout
+    times = [float(run()) for _ in range(5)]
+    yield "imports", min(times) * 1000, "ms", False
+
+
+class ActionList(list): # what internet_action extends the screen's actions with
+    def find(self, name):
+        return [data for action, data in self if action == name]
+
+    def count(self, name):
+        return sum(1 for action, _ in self if action == name)
+
+
+class BenchScreen: # stands in for ServerScreen / ClientScreen / GameScreen, collects their actions
+    def __init__(self):
+        self.actions = ActionList()
+        self.accept = None
+        self.ended = False
+
+    def add_action(self, name, data, *dt):
+        self.actions.append((name, data))
+
+
+@benchmark
+def loopback_match(): # whole lobby handshake and two seconds of play between Server and Client on this PC
+    from server import Server # network classes are only needed here
+    from client import Client
+
+    host, frequency = settings.HOST, settings.server_frequency
+    settings.HOST, settings.server_frequency = "127.0.0.1", 0.05
+    server, client = Server(), Client()
+    try:
+        server_screen, client_screen = BenchScreen(), BenchScreen()
+        server.initialize("bench", server_screen)
+        if not server.working:
+            return
+
+        client.screen, client.client_name, client.seeking = client_screen, "bench", True
+        socket_ = client.get_empty_socket()
+        client.rooms.add(server.address)
+        t0 = time.perf_counter()
+        server_name, address = client.test_server(server.address, socket_)
+        address = tuple(address)
+        start_new_thread(client.listen_server, (socket_, server_name, address, server.address, time.time()))
+        client.request_game(address)
+        while not server.clients or not server_screen.actions.find("ADD"):
+            time.sleep(0.001)
+        server.accept_game(server_screen.actions.find("ADD")[0][1])
+        while not client_screen.actions.find("START"):
+            time.sleep(0.001)
+        yield "handshake", time.perf_counter() - t0, "s", False
+
+        t0, cpu = time.perf_counter(), time.process_time()
+        idx = 0
+        while time.perf_counter() - t0 < 2:
+            idx += 1
+            server.update_data = game_update(idx)
+            client.update_data = (idx, (1,))
+            time.sleep(1 / settings.fps)
+        seconds = time.perf_counter() - t0
+        yield "cpu", (time.process_time() - cpu) / seconds, "s/s", False
+        yield "client frames", server_screen.actions.count("UPDATE") / seconds, "1/s", True
+        yield "server frames", client_screen.actions.count("UPDATE") / seconds, "1/s", True
+
+        latencies = []
+        for _ in range(20):
+            sent = time.perf_counter()
+            start = len(client_screen.actions)
+            server.event_dispatcher("PAUSE_SCREEN", None)
+            while not any(name == "PAUSE_SCREEN" for name, _ in client_screen.actions[start:]):
+                if time.perf_counter() - sent > settings.connection_timeout:
+                    raise TimeoutError("event was not delivered")
+                time.sleep(0.0002)
+            latencies.append(time.perf_counter() - sent)
+        yield "event latency", sorted(latencies)[len(latencies) // 2] * 1000, "ms", False
+    finally:
+        client.abandon()
+        time.sleep(0.2)
+        server.reset()
+        client.reset()
+        settings.HOST, settings.server_frequency = host, frequency
+
+
+def calibration(): # pure python loop, tells how fast this machine is right now
+    def loop():
+        total = 0
+        for idx in range(1000):
+            total += idx * idx
+        return total
+    return timed(loop, 200, 10)
+
+
+def run(pattern=""): # calibration runs around every benchmark, machine's speed changes during a whole run
+    results = {}
+    speeds = []
+    for name, function in BENCHMARKS:
+        if pattern not in name:
+            continue
+        before = calibration()
+        try:
+            metrics = list(function() or [])
+        except ImportError as e: # optional dependency, like numpy for BatchEngine
+            print(f"{name} skipped ({e})", file=sys.stderr)
+            continue
+        speed = (before + calibration()) / 2
+        speeds.append(speed)
+        for metric, value, unit, higher in metrics:
+            results[f"{name}: {metric}"] = {"value": value, "unit": unit, "higher_is_better": higher, "calibration": speed}
+    results["calibration"] = {"value": sorted(speeds)[len(speeds) // 2], "unit": "µs", "higher_is_better": False}
+    return results
+
+
+# prints a table, returns names of metrics that got worse than tolerance allows
+# µs timings and steps/s rates are scaled by the calibration measured around their benchmark,
+# so a slower machine or a throttled cpu doesn't look like a regression
+def compare(results, baseline, tolerance, noise_floor):
+    regressions = []
+    if "calibration" in baseline:
+        print(f"Timings scaled by {baseline['calibration']['value'] / results['calibration']['value']:.2f} (median) to the speed of the baseline machine")
+    print(f"{'benchmark':<44}{'baseline':>12}{'now':>12}{'change':>10}")
+    for name, result in results.items():
+        value, unit = result["value"], result["unit"]
+        if name == "calibration": # it only measures the machine, nothing to regress
+            print(f"{name:<44}{baseline.get(name, {}).get('value', 0):>12.4g}{value:>12.4g} {unit}")
+            continue
+        old = baseline.get(name, {}).get("value")
+        if not old:
+            print(f"{name:<44}{'-':>12}{value:>12.4g} {unit}")
+            continue
+        scale = baseline[name].get("calibration", 1) / result.get("calibration", 1)
+        if unit == "µs":
+            value *= scale
+        elif unit == "steps/s": # cpu bound rate, unlike network paced frames in 1/s
+            value /= scale
+        change = value / old - 1
+        worse = -change if result["higher_is_better"] else change
+        allowed = max([tolerance] + [noisy for prefix, noisy in NOISY.items() if name.startswith(prefix)])
+        mark = ""
+        if worse > allowed and not (unit == "µs" and value - old <= noise_floor):
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print(f"{name:<44}{old:>12.4g}{value:>12.4g} {unit:<4}{change * 100:>+7.1f} %{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the game's hot paths.")
+    parser.add_argument("-k", default="", help="run only benchmarks with this in their name")
+    parser.add_argument("--save", action="store_true", help=f"store results as the new baseline ({BASELINE})")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--output", help="write results as json into this file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed slowdown before it counts as a regression")
+    parser.add_argument("--noise-floor", type=float, default=NOISE_FLOOR, help="µs a timing may grow by regardless of tolerance")
+    args = parser.parse_args()
+
+    results = run(args.k)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        baseline = {}
+    regressions = compare(results, baseline, args.tolerance, args.noise_floor)
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,55 @@
-from widgets import Paddle
+from random import Random
+
 from settings import settings
 
 
-class Bot(Paddle):
+# chooses move direction of the paddle it controls, engine moves it by settings.botMoveSpeed
+# bot aims where the ball will cross its paddle, worked out once per bounce or serve
+class Bot:
+    def __init__(self, seed=None):
+        self.random = Random(seed)
+        self.reset()
+
+    def reset(self): # forget the predicted trajectory, called on every serve
+        self.velocity = None # ball velocity (x, |y|) the prediction was made for, wall bounces don't change the prediction
+        self.target = 0.5 # center y the paddle goes to
+        self.pending = None # (tick, target) the bot switches to once its reaction delay is over
+
     @staticmethod
-    def move(me, root):
-        _, dy = root.ball.velocity
-
-        if dy > 0 and root.ball.center_y > me.center_y: # move up if ball's center is above our center
-            new = me.top + settings.botMoveSpeed * root.height
-            me.top = min(new, root.top)
-        elif dy < 0 and root.ball.center_y < me.center_y: # move down if ball's center is above our center
-            new = me.y - settings.botMoveSpeed * root.height
-            me.y = max(new, root.y)
\ No newline at end of file
+    def intercept(me, state): # ball's center y when it reaches our paddle, None if ball goes away
+        ball = state.ball
+        if me.x < state.width / 2:
+            distance, approaching = ball.x - me.right, ball.velocity_x < 0
+        else:
+            distance, approaching = me.x - ball.right, ball.velocity_x > 0
+        if not approaching or distance < 0:
+            return None
+
+        y = ball.y + ball.velocity_y * distance / abs(ball.velocity_x)
+        span = 1 - ball.size # walls reflect the ball, so fold its straight path back into the field
+        y %= 2 * span
+        if y > span:
+            y = 2 * span - y
+        return y + ball.size / 2
+
+    def move(self, me, state):
+        ball = state.ball
+        velocity = (ball.velocity_x, abs(ball.velocity_y))
+        if velocity != self.velocity:
+            self.velocity = velocity
+            target = self.intercept(me, state)
+            if target is None: # wait in the middle for the return
+                target = 0.5
+            else:
+                target += self.random.uniform(-settings.bot_error, settings.bot_error)
+            self.pending = (state.tick + round(settings.bot_reaction * settings.fps), target)
+
+        if self.pending is not None and state.tick >= self.pending[0]:
+            self.target = self.pending[1]
+            self.pending = None
+
+        if self.target > me.center_y + me.speed / 2: # move up if target is above our center
+            return 1
+        elif self.target < me.center_y - me.speed / 2: # move down if target is below our center
+            return -1
+        return 0
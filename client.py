@@ -1,14 +1,18 @@
 from _thread import *
 import time
 import socket
+import selectors
 
 from settings import *
 from internet import Internet
+from netcode import LinkStats
+import protocol
 
 
 class Client(Internet):
     def __init__(self):
         self.type_ = "client"
+        self.outgoing = protocol.INPUT # opcode of game frames we send
         self.reset(True)
 
     def reset(self, initial=False):
@@ -23,6 +27,10 @@ class Client(Internet):
         self.client_name = ""
         self.seeking = False # marks if we are searching for new servers or maintaining connection with one that doesn't play against us
         self.waiting = False
+        self.spectating = False # we only watch server's game
+        self.player_name = "" # name of the player on our side of the screen
+        self.busy = set() # servers that play, so we can only watch them
+        self.announced = {} # lobby address -> time of his last announcement, we contact him only when user picks him
         self.reset_internet(initial)
 
     def initialize(self, client_name, screen):
@@ -32,10 +40,17 @@ class Client(Internet):
         self.seeking = True 
 
         self.socket_ = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        start_new_thread(self.seek, ())
+        start_new_thread(self.listen_announcements if settings.announce else self.seek, ())
 
     def request_game(self, server_address):
-        self.server_address = server_address
+        if server_address in self.announced: # we only heard of him, connect to him now
+            start_new_thread(self.contact, (server_address,))
+        else:
+            self.server_address = server_address
+
+    def spectate(self, server_address):
+        self.spectating = True
+        self.request_game(server_address)
         
     # test if binded server is open. If yes, return its name
     def test_server(self, address, socket_, initial=True): 
@@ -58,18 +73,20 @@ class Client(Internet):
     def connection_error(self, is_server, address, old_address, socket_):
         f = self.screen is not None and self.playing and self.screen.ended == True # prevents sending leave on game_end
         if not f:
-            if not self.seeking and self.server_address != address: # planned exit
+            if self.server_address != address and (not self.seeking or old_address in self.announced): # planned exit
                     self.send(socket_, LEAVE, address)
             else:
-                self.screen.add_action("REMOVE", address)
-                self.rooms.remove(old_address)
+                if old_address not in self.announced: # announced servers stay listed until they stop announcing
+                    self.screen.add_action("REMOVE", address)
+                    self.rooms.discard(old_address)
+                    self.busy.discard(address)
 
                 if self.playing and is_server: # if we play against this server
                     self.screen.add_action("ERROR", ("Server lost", "Game crashed due to lost connection with a host"))
                     self.screen.add_action("LEAVE", None)
                 elif self.waiting and is_server: # if we wait for this server to accept us
                     self.server_address = None
-                    self.waiting = False
+                    self.waiting = self.spectating = False
                     self.screen.add_action("STOP WAITING", ("Server Lost", "Unable to join the server."))
         self.shutdown(socket_)
 
@@ -79,15 +96,24 @@ class Client(Internet):
             self.send(socket_, data, address)
 
         refresh = settings.server_frequency
-        while self.seeking or address == self.server_address: # if we maintain connections with all servers or its our oponent
+        selector = selectors.DefaultSelector()
+        selector.register(socket_, selectors.EVENT_READ)
+        link = LinkStats(f"Server {address}") # lobby round trip, shown in the servers list
+        # if we maintain connections with all servers (announced ones are kept by their announcements) or its our oponent
+        while (self.seeking and old_address not in self.announced) or address == self.server_address:
             is_server = address == self.server_address
+            pinged = False
             t1 = time.time()
             
-            if t1 - t0 > settings.connection_timeout:
+            timeout = settings.connection_timeout if self.playing and is_server else settings.lobby_timeout()
+            if t1 - t0 > timeout:
                 settings.inform(f"Connection timeout ({address}).")
                 break # will call connecion_error
-            
-            data = self.data_recive(socket_)
+
+            if self.playing and is_server: # sleep until a packet, the next game frame or connection timeout
+                data = self.wait(selector, socket_, min(self.next_send, t0 + settings.connection_timeout))
+            else:
+                data = self.data_recive(socket_)
 
             if data == LEAVE:
                 settings.inform(f"Server {address} left.")
@@ -95,6 +121,7 @@ class Client(Internet):
 
             # we have some action with that server
             elif is_server:
+                opponent = data.pop("opponent", None) # room servers tell us who we play against
                 if data == ABANDON: # if other side abandoned the connection
                     settings.inform(f"Server {address} abandoned us.")
                     send(REQUEST_RECIVED)
@@ -103,6 +130,7 @@ class Client(Internet):
                     if self.playing: # if we were playing against it
                         self.screen.add_action("ERROR", ("Server lost", "Player left a game"))
                         self.screen.add_action("LEAVE", None)
+                        selector.close()
                         return
                     else:
                         break # will call connecion_error
@@ -112,15 +140,37 @@ class Client(Internet):
                     send(ABANDON)
                     self.abandon_ = False
                     self.waiting = False
+                    self.spectating = False
                     self.server_address = None
 
                     if self.playing: # if we are playing against it
                         self.screen.add_action("LEAVE", None)
+                        selector.close()
                         return
 
                 elif self.playing and is_server: # if we are playing with him
                     self.internet_action(data, send)
 
+                elif self.spectating and self.waiting and data == WATCHING: # server let us watch
+                    settings.inform(f"Watching the game of {address}")
+                    self.waiting = False
+                    self.playing = True
+                    self.seeking = False
+                    self.server_name = server_name
+                    self.player_name = opponent
+                    refresh = settings.server_time_refresh
+                    self.drain_wakeup() # forget signals from before the game
+                    selector.register(self.wakeup, selectors.EVENT_READ)
+                    self.screen.add_action("START", self)
+
+                elif self.spectating:
+                    if not self.waiting: # ask to watch
+                        settings.inform(f"Requesting to watch the game of {address}.")
+                        send(WATCH)
+                        self.waiting = True
+                    else:
+                        send(ALIVE) # keep the connection until he answers
+
                 elif data == BUSY:
                     settings.inform(f"Server {address} started anorher game")
                     self.waiting = False
@@ -134,8 +184,10 @@ class Client(Internet):
                     self.waiting = False
                     self.playing = True
                     self.seeking = False
-                    self.server_name = server_name
+                    self.server_name = opponent or server_name
                     refresh = settings.server_time_refresh # set waiting to game waiting (much smaller)
+                    self.drain_wakeup() # forget signals from before the game
+                    selector.register(self.wakeup, selectors.EVENT_READ) # game thread wakes us when it has events to send
                     self.screen.add_action("START", self)
 
                 elif not self.waiting: # request the game
@@ -150,38 +202,149 @@ class Client(Internet):
 
             # we know that the server exists but we don't have an action with it
             else:
-                if data == BUSY: # if server is not longer open for us
-                    settings.inform(f"Connection to {address} is busy, closing it.")
-                    break # will call connecion_error
+                if data == BUSY: # server plays, we can only watch him
+                    if address not in self.busy:
+                        settings.inform(f"Server {address} is playing.")
+                        self.busy.add(address)
+                        self.screen.add_action("BUSY", address)
+                    send(ALIVE) # tell him we are here
+                    link.ping()
+                    pinged = True
                 else:
                     send(ALIVE) # tell him we are here
+                    link.ping()
+                    pinged = True
                     server_name = data.pop("server_name", None) # check if he contacted us
                     if server_name is not None and data == REQUEST_RECIVED:
                         settings.inform(f"Connection to {address} is still open.")
 
             if data: # there was an interaction with server, reset timer
                 t0 = t1
-            time.sleep(refresh)
+            if pinged: # note when his answer arrives, it is read in the next loop
+                deadline = time.time() + refresh
+                if selector.select(refresh):
+                    link.pong()
+                    self.screen.add_action("PING", (address, link.rtt))
+                time.sleep(max(deadline - time.time(), 0))
+            else:
+                time.sleep(refresh)
         
+        selector.close()
         self.connection_error(is_server, address, old_address, socket_)
 
+    # probes all addresses at once and collects answers until one common deadline
+    def discover(self, socket_, addresses):
+        addresses = set(addresses)
+        for address in addresses:
+            self.send(socket_, DISCOVER, address)
+
+        found = []
+        deadline = time.time() + settings.socket_timeout
+        while addresses:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            socket_.settimeout(remaining)
+            data, address = self.recive(socket_)
+            if address in addresses:
+                server_name = data.pop("server_name", None)
+                if server_name is not None and data == REQUEST_RECIVED:
+                    addresses.remove(address)
+                    found.append((server_name, address))
+        socket_.settimeout(settings.socket_timeout)
+        return found
+
+    def join_server(self, address): # get a dedicated address from found server and keep connection with it
+        socket_ = self.get_empty_socket()
+        server_name, new_address = self.test_server(address, socket_)
+
+        if server_name is not None: # if it is our server and it's open for us
+            new_address = tuple(new_address)
+            settings.inform(f"New connection found at {address}, redirected to {new_address}.")
+            self.screen.add_action("ADD", (server_name, new_address))
+            self.rooms.add(address)
+            start_new_thread(self.listen_server, (socket_, server_name, new_address, address, time.time()))
+        else:
+            self.shutdown(socket_)
+
     def seek(self):
         socket_ = self.get_empty_socket()
 
         while self.seeking: # as long as we seek connection with a new server
-            for ip in Internet.get_devices():
-                for port in range(settings.PORT, settings.MAX_PORT + 1):
-                    address = (ip, port)
-
-                    if address not in self.rooms: # if we aren't connected to him
-                        server_name, new_address = self.test_server(address, socket_)
-
-                        if server_name is not None: # if it is our server and it's open for us
-                            new_address = tuple(new_address)
-                            settings.inform(f"New connection found at {address}, redirected to {new_address}.")
-                            self.screen.add_action("ADD", (server_name, new_address))
-                            self.rooms.add(address)
-                            start_new_thread(self.listen_server, (socket_, server_name, new_address, address, time.time()))
-                            socket_ = self.get_empty_socket() # request new socket to seeking the servers
-                time.sleep(settings.server_frequency)
-                        
\ No newline at end of file
+            addresses = [
+                (ip, port) 
+                for ip in Internet.get_devices() 
+                for port in range(settings.PORT, settings.MAX_PORT + 1)
+            ]
+            addresses = [address for address in addresses if address not in self.rooms] # if we aren't connected to him
+
+            for _, address in self.discover(socket_, addresses):
+                self.join_server(address)
+            time.sleep(settings.server_frequency)
+        self.shutdown(socket_)
+
+    def get_announce_socket(self):
+        socket_ = self.get_empty_socket()
+        socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # more clients might listen on one PC
+        if hasattr(socket, "SO_REUSEPORT"):
+            socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socket_.bind(("", settings.announce_port))
+
+        if settings.multicast():
+            group = socket.inet_aton(settings.announce_address) + socket.inet_aton("0.0.0.0")
+            socket_.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, group)
+        return socket_
+
+    def contact(self, address): # get a dedicated address from announced server user picked and play or watch him
+        socket_ = self.get_empty_socket()
+        server_name, new_address = self.test_server(address, socket_)
+
+        if server_name is None:
+            settings.inform(f"Unable to contact {address}.")
+            self.shutdown(socket_)
+            self.spectating = False
+            if self.abandon_: # user gave up meanwhile
+                self.abandon_ = False
+            else:
+                self.screen.add_action("STOP WAITING", ("Server Lost", "Unable to join the server."))
+            return
+        new_address = tuple(new_address)
+        settings.inform(f"Contacted {address}, redirected to {new_address}.")
+        self.server_address = new_address
+        start_new_thread(self.listen_server, (socket_, server_name, new_address, address, time.time()))
+
+    def announcement(self, address, server_name, free, t1): # list the server as he describes himself
+        if address not in self.announced:
+            settings.inform(f"Server {server_name} announced at {address}.")
+            self.rooms.add(address)
+            self.screen.add_action("ADD", (server_name, address))
+        self.announced[address] = t1
+        if not free and address not in self.busy: # he plays, we can only watch him
+            self.busy.add(address)
+            self.screen.add_action("BUSY", address)
+        elif free and address in self.busy:
+            self.busy.discard(address)
+            self.screen.add_action("FREE", address)
+
+    def listen_announcements(self): # passive alternative to seek, servers are contacted only when user picks them
+        try:
+            socket_ = self.get_announce_socket()
+        except Exception as e:
+            settings.handle_error(e)
+            self.seek() # unable to listen, scan the network instead
+            return
+
+        while self.seeking: # as long as we seek connection with a new server
+            data, address = self.recive(socket_)
+            t1 = time.time()
+            if data.keys() == ANNOUNCE.keys():
+                self.announcement((address[0], data["port"]), data["announce"], data["free"], t1)
+
+            for address, seen in list(self.announced.items()):
+                if t1 - seen > settings.announce_timeout: # he stopped announcing himself
+                    settings.inform(f"Server {address} stopped announcing.")
+                    del self.announced[address]
+                    self.rooms.discard(address)
+                    self.busy.discard(address)
+                    self.screen.add_action("REMOVE", address)
+        self.shutdown(socket_)
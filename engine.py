@@ -0,0 +1,232 @@
+from math import cos, sin, radians
+
+from settings import settings
+
+
+# all lengths are expressed in screen heights, so the field is 1 high and `width` (aspect ratio) wide
+# velocities are in screen heights per tick, exactly like settings.speed and settings.moveSpeed
+
+class PaddleState:
+    __slots__ = ("x", "y", "width", "height", "speed", "direction", "score", "scored")
+
+    def __init__(self, height, speed):
+        self.x = self.y = self.width = 0.
+        self.height = height
+        self.speed = speed
+        self.direction = 0 # -1 down, 0 stay, 1 up
+        self.score = 0
+        self.scored = False # marks that this paddle took the last point (drawn green)
+
+    @property
+    def right(self):
+        return self.x + self.width
+
+    @property
+    def top(self):
+        return self.y + self.height
+
+    @property
+    def center_y(self):
+        return self.y + self.height / 2
+
+
+class BallState:
+    __slots__ = ("x", "y", "size", "velocity_x", "velocity_y")
+
+    def __init__(self, size):
+        self.x = self.y = 0.
+        self.size = size
+        self.velocity_x = self.velocity_y = 0.
+
+    @property
+    def right(self):
+        return self.x + self.size
+
+    @property
+    def top(self):
+        return self.y + self.size
+
+    @property
+    def center_x(self):
+        return self.x + self.size / 2
+
+    @property
+    def center_y(self):
+        return self.y + self.size / 2
+
+
+class GameState:
+    __slots__ = ("width", "ball", "player1", "player2", "gg", "cc", "streak", "tick")
+
+    def __init__(self, width, paddle_height, ball_size):
+        self.width = width
+        self.ball = BallState(ball_size)
+        self.player1 = PaddleState(paddle_height, settings.moveSpeed)
+        self.player2 = PaddleState(paddle_height, settings.moveSpeed)
+        self.gg = False # turn is active
+        self.cc = False # countdown is active
+        self.streak = 0 # number of bounces in this turn or seconds left in the countdown
+        self.tick = 0 # simulation clock, advanced by whoever drives the game (also between games)
+
+    @property
+    def players(self):
+        return self.player1, self.player2
+
+
+class PongEngine: # pure python game rules, GameScreen only renders its state
+    paddle_width = 0.02 # part of the screen width, as in style.kv
+    paddle_height = 0.33
+    ball_size = 0.05
+    max_impacts = 8 # bounces resolved within one tick
+    WALL = "wall"
+
+    def __init__(self, width=4 / 3):
+        self.state = GameState(width, self.paddle_height, self.ball_size)
+        self.resize(width)
+        self.reset()
+
+    def resize(self, width): # keep paddles at the sides after aspect ratio changed
+        state = self.state
+        state.width = width
+        paddle_width = self.paddle_width * width
+        for paddle in state.players:
+            paddle.width = paddle_width
+        state.player1.x = paddle_width / 2
+        state.player2.x = width - paddle_width * 1.5
+
+    def reset(self):
+        state = self.state
+        for paddle in state.players:
+            paddle.score = 0
+        self.reset_players()
+        state.gg = state.cc = False
+        state.streak = 0
+        self.center_ball()
+
+    def reset_players(self): # set all players in starting positions and mark none as scoring
+        for paddle in self.state.players:
+            paddle.direction = 0
+            paddle.scored = False
+            paddle.y = (1 - paddle.height) / 2
+
+    def center_ball(self):
+        ball = self.state.ball
+        ball.x = (self.state.width - ball.size) / 2
+        ball.y = (1 - ball.size) / 2
+
+    def serve(self, direction, angle): # angle in degrees, counterclockwise
+        self.reset_players()
+        self.center_ball()
+        speed = direction * settings.speed
+        ball = self.state.ball
+        ball.velocity_x = speed * cos(radians(angle))
+        ball.velocity_y = speed * sin(radians(angle))
+        self.state.gg = True
+
+    def move_paddle(self, paddle, direction=None):
+        if direction is None:
+            direction = paddle.direction
+        if direction == 1: # up
+            paddle.y = min(paddle.y + paddle.speed, 1 - paddle.height) # don't move out the screen
+        elif direction == -1: # down
+            paddle.y = max(paddle.y - paddle.speed, 0) # don't move out the screen
+
+    def overlaps(self, paddle):
+        ball = self.state.ball
+        return not (ball.right < paddle.x or ball.x > paddle.right or ball.top < paddle.y or ball.y > paddle.top)
+
+    def approaching(self, paddle): # ball moves towards paddle's side, so it can't get stuck inside the paddle
+        return (paddle.x < self.state.width / 2) == (self.state.ball.velocity_x < 0)
+
+    # first thing the ball hits within `remaining` part of the tick: (time of impact, WALL / paddle / None)
+    # ball is swept along its path, so it can't tunnel through anything however fast it goes
+    def impact(self, remaining):
+        state = self.state
+        ball = state.ball
+        velocity_x, velocity_y = ball.velocity_x, ball.velocity_y
+        time, target = remaining, None
+
+        if velocity_y > 0: # top and bottom
+            wall = max((1 - ball.top) / velocity_y, 0)
+        elif velocity_y < 0:
+            wall = max(-ball.y / velocity_y, 0)
+        else:
+            wall = time
+        if wall < time:
+            time, target = wall, self.WALL
+
+        for paddle in state.players:
+            if velocity_x == 0 or not self.approaching(paddle):
+                continue
+            if self.overlaps(paddle): # paddle moved onto the ball
+                return 0, paddle
+            # time when ball's leading side reaches paddle's side facing the field
+            if velocity_x < 0:
+                hit = (paddle.right - ball.x) / velocity_x
+            else:
+                hit = (paddle.x - ball.right) / velocity_x
+            if 0 <= hit < time:
+                y = ball.y + velocity_y * hit
+                if y <= paddle.top and y + ball.size >= paddle.y:
+                    time, target = hit, paddle
+        return time, target
+
+    def bounce_ball(self, paddle):
+        ball = self.state.ball
+        ball.velocity_x *= -settings.speedup
+        ball.velocity_y *= settings.speedup * 1.1
+        self.state.streak += 1
+
+    # inputs are move directions of player1 and player2, None leaves the paddle untouched
+    # returns 1 or 2 if that player took the point during this tick, 0 otherwise
+    def step(self, inputs=(None, None)):
+        state = self.state
+        if not state.gg:
+            return 0
+
+        for paddle, direction in zip(state.players, inputs):
+            if direction is not None:
+                self.move_paddle(paddle, direction)
+
+        ball = state.ball
+        remaining = 1.
+        for _ in range(self.max_impacts):
+            time, target = self.impact(remaining)
+            ball.x += ball.velocity_x * time
+            ball.y += ball.velocity_y * time
+            remaining -= time
+            if target is None:
+                break
+            if target is self.WALL: # bounce off top or bottom
+                ball.velocity_y *= -1
+            else: # bounce off the paddle
+                self.bounce_ball(target)
+        else: # ball is stuck between walls and paddles, finish the move without bouncing
+            ball.x += ball.velocity_x * remaining
+            ball.y += ball.velocity_y * remaining
+
+        # went off the side - turn ends
+        if ball.x < 0:
+            return 2
+        elif ball.right > state.width:
+            return 1
+        return 0
+
+    def end_turn(self, scorer): # scorer is 1 or 2
+        state = self.state
+        state.gg = False # mark turn end
+        state.streak = 0 # reset streak
+        self.center_ball() # pause now won't take twice the same turn end
+        self.reward(scorer)
+
+    def reward(self, scorer): # scorer is 1 or 2
+        paddle = self.state.players[scorer - 1]
+        paddle.scored = True
+        paddle.score += 1
+
+    def winner(self): # 1 or 2 if that player has won the match, 0 otherwise
+        for idx, paddle in enumerate(self.state.players, 1):
+            if paddle.score >= settings.rounds_to_win:
+                return idx
+        return 0
+
@@ -1,27 +1,66 @@
-from kivy.core.window import Window
-from kivy.vector import Vector
+import time
+from collections import deque
+from threading import Lock
 
-from widgets import ErrorPopup
 from settings import settings
 
 
+class ActionQueue: # screens' inbox, network threads put actions in and Kivy thread takes them out
+    def __init__(self):
+        self.lock = Lock()
+        self.queue = deque() # [name, data] entries, name is None if entry was replaced by a newer one
+        self.coalesced = set() # names of actions of which only the newest one matters
+        self.latest = {} # name -> its newest entry still in the queue
+
+    def coalesce(self, name):
+        self.coalesced.add(name)
+
+    def put(self, name, data):
+        entry = [name, data]
+        with self.lock:
+            if name in self.coalesced:
+                stale = self.latest.get(name)
+                if stale is not None: # skip it, newer one is applied after the actions that came in between
+                    stale[0] = None
+                self.latest[name] = entry
+            self.queue.append(entry)
+
+    def extend(self, actions):
+        for name, data in actions:
+            self.put(name, data)
+
+    def take(self, budget=None): # removes and returns at most budget actions, oldest first
+        taken = []
+        with self.lock:
+            while self.queue and (budget is None or len(taken) < budget):
+                entry = self.queue.popleft()
+                name, data = entry
+                if name is None:
+                    continue
+                if self.latest.get(name) is entry:
+                    del self.latest[name]
+                taken.append((name, data))
+        return taken
+
+
 class EventManager: # helper for GameScreen
 
     def on_key_down(self, keyboard, keycode, text, modifiers):
-        if self.gg: # if during round
+        state = self.engine.state
+        if state.gg: # if during round
             val = keycode[1]
 
             # if this PC plays 
             if val == "up" and self.opt in ["client", "server", "offline", "solo"]:
-                self.player2.move_direction = 1
+                state.player2.direction = 1
             elif val == "down" and self.opt in ["client", "server", "offline", "solo"]:
-                self.player2.move_direction = -1
+                state.player2.direction = -1
 
             # if this PC's keyboard can move second player as well
             elif val == "w" and self.opt == "offline":
-                self.player1.move_direction = 1
+                state.player1.direction = 1
             elif val == "s" and self.opt == "offline":
-                self.player1.move_direction = -1
+                state.player1.direction = -1
 
             else:
                 return False
@@ -29,20 +68,21 @@ class EventManager: # helper for GameScreen
         return False
 
     def on_key_up(self, keyboard, keycode):
-        if self.gg: # if during round
+        state = self.engine.state
+        if state.gg: # if during round
             val = keycode[1]
 
             # if this PC plays 
             if val == "up" and self.opt in ["client", "server", "offline", "solo"]:
-                self.player2.move_direction = 0
+                state.player2.direction = 0
             elif val == "down" and self.opt in ["client", "server", "offline", "solo"]:
-                self.player2.move_direction = 0
+                state.player2.direction = 0
 
             # if this PC's keyboard can move second player as well
             elif val == "w" and self.opt == "offline": 
-                self.player1.move_direction = 0
+                state.player1.direction = 0
             elif val == "s" and self.opt == "offline":
-                self.player1.move_direction = 0
+                state.player1.direction = 0
 
             else:
                 return False
@@ -50,62 +90,78 @@ class EventManager: # helper for GameScreen
         return False
 
     def handle_game_action(self):
-         if self.gg: # if during round
-            if self.opt in ["server", "offline", "solo"]: # if user is a player
-                self.player2.move(self.player2, self)
-            if self.opt in ["offline", "solo"]: # if opponent is bot or physically with us
-                self.player1.move(self.player1, self)
-
-            if self.opt in ["server", "offline", "solo"]: # if game is beeing calculated by that computer
-                self.ball.move()
-
-                # bounce off top and bottom
-                if self.ball.y < 0 or self.ball.top > self.height:
-                    self.ball.velocity_y *= -1
-                # bounce off the paddles
-                p1 = self.player1.bounce_ball(self.ball)
-                p2 = self.player2.bounce_ball(self.ball)
-                if p1 or p2:
-                    self.ball.velocity_y *= 1.1
-                    self.streak += 1
-
-                # went off the side - turn ends
-                if self.ball.x < self.x:
-                    self.turn_end(self.player2, 1)
-                elif self.ball.right > self.width:
-                    self.turn_end(self.player1, -1)
+        state = self.engine.state
+        computing = self.opt in ["server", "offline", "solo"] # if game is beeing calculated by that computer
+        if computing:
+            if self.recorder is not None:
+                self.recorder.begin(state)
+            state.tick += 1
+        if self.opt == "server": # client's inputs are applied one per tick, in the order he made them
+            state.player1.direction = self.inputs.next()
+        elif self.opt == "solo" and state.gg: # opponent is a bot
+            state.player1.direction = self.bot.move(state.player1, state)
+
+        if computing:
+            inputs = (state.player1.direction, state.player2.direction)
+            if self.recorder is not None:
+                self.recorder.tick(state, inputs)
+            scorer = self.engine.step(inputs) # nothing happens outside of a round
+            if scorer == 2: # went off the left side
+                self.turn_end(2, 1)
+            elif scorer == 1: # went off the right side
+                self.turn_end(1, -1)
+
+        elif self.opt == "client": # don't wait for the server to move our paddle
+            self.predictor.predict(self.engine, state.player2, state.gg)
+
+    def dispatch(self, name, value): # sends event to the other player
+        if self.recorder is not None:
+            self.recorder.event(name, value)
+        self.internet.event_dispatcher(name, value)
+
+    def interpolate(self): # place remote ball and paddle between last received snapshots
+        values = self.interpolation.sample(time.perf_counter())
+        if values is not None:
+            state = self.engine.state
+            ball_x, ball_y, state.player1.y, player2_y = values
+            if self.opt == "spectate": # nobody predicts the other paddle for us
+                state.player2.y = player2_y
+            state.ball.x = state.width * ball_x - state.ball.size / 2
+            state.ball.y = ball_y - state.ball.size / 2
 
     def handle_actions(self):
-        while len(self.actions):
-            name, data = self.actions.pop(0)
+        for name, data in self.actions.take(settings.actions_per_tick):
+            if self.recorder is not None and name != "UPDATE": # effect of updates is in recorded inputs
+                self.recorder.event(name, data)
 
             match name: # for all game options
                 case "UPDATE" if data:
-                    if self.opt == "server" and self.gg:
+                    state = self.engine.state
+                    if self.opt == "server":
+                        self.inputs.receive(*data)
+                    elif self.opt in ["client", "spectate"]: # spectators get the same stream as the client
                         (
-                            self.player1.move_direction,
-                        ) = data
-                        self.player1.move(self.player1, self)
-                    elif self.opt == "client":
-                        (
-                            self.gg,
-                            self.cc,
-                            self.streak,
-                            ball_center,
+                            state.gg,
+                            state.cc,
+                            state.streak,
+                            (ball_x, ball_y),
                             player2_y,
-                            self.player2.color,
-                            self.player2.score,
+                            state.player2.scored,
+                            state.player2.score,
                             player1_y,
-                            self.player1.color,
-                            self.player1.score,
-                        ) = data 
-                        self.player1.y = Window.size[1] * player1_y
-                        self.player2.y = Window.size[1] * player2_y
-                        ball_center = Vector(*Window.size) * Vector(*ball_center)
-                        self.ball.center = [self.right - ball_center[0], ball_center[1]] # lient ball x coordinate is mirrorded from server's one
-                        if not self.gg:
-                            self.player2.move_direction = 0 # stop moving so on the turn start paddle won't "fly" in unexpected direction by itself
+                            state.player1.scored,
+                            state.player1.score,
+                            stamp,
+                            acked,
+                        ) = data
+                        # client ball x coordinate is mirrorded from server's one
+                        self.interpolation.push(stamp / 1000, (1 - ball_x, ball_y, player1_y, player2_y), time.perf_counter())
+                        if self.opt == "client": # our paddle is predicted, server only corrects it
+                            self.predictor.correct(self.engine, state.player2, player2_y, acked, state.gg)
+                            if not state.gg:
+                                state.player2.direction = 0 # stop moving so on the turn start paddle won't "fly" in unexpected direction by itself
                 case "ERROR": # connection to second player lost or he left
+                    from widgets import ErrorPopup # kivy is imported only when a popup is shown, game logic runs without it
                     ErrorPopup(*data).open()
                 case "LEAVE":
                     self.manager.current = "menu"
@@ -121,9 +177,11 @@ class EventManager: # helper for GameScreen
                         self.pause()
                         self.add_action("PAUSE_SCREEN", None) # set pause screen 
                         if self.opt == "server": # set pause screen in client
-                            self.internet.event_dispatcher("PAUSE_SCREEN", None)
+                            self.dispatch("PAUSE_SCREEN", None)
                     elif self.opt == "client":
-                        self.internet.event_dispatcher("PAUSE", None) # send request to the server
+                        self.dispatch("PAUSE", None) # send request to the server
+                    else: # spectator can't pause the game, only leave it from the pause screen
+                        self.add_action("PAUSE_SCREEN", None)
                 case "PAUSE_SCREEN":
                     settings.inform("Game paused.")
                     self.manager.transition.duration = 0
@@ -133,9 +191,11 @@ class EventManager: # helper for GameScreen
                         self.unpause()
                         self.add_action("UNPAUSE_SCREEN", None) # discard pause screen
                         if self.opt == "server": # discard pause screen in client
-                            self.internet.event_dispatcher("UNPAUSE_SCREEN", None)
+                            self.dispatch("UNPAUSE_SCREEN", None)
                     elif self.opt == "client":
-                        self.internet.event_dispatcher("UNPAUSE", None) # send request to the server
+                        self.dispatch("UNPAUSE", None) # send request to the server
+                    else:
+                        self.add_action("UNPAUSE_SCREEN", None)
                 case "UNPAUSE_SCREEN":
                     settings.inform("Game unpaused.")
                     self.manager.transition.duration = 0
@@ -146,20 +206,23 @@ class EventManager: # helper for GameScreen
         return True
 
     def send_data(self):
+        state = self.engine.state
         if self.opt == "client":
+            self.internet.update_data = self.predictor.history()
+        elif self.opt == "spectate": # no inputs, only acknowledge the last frame we got
+            self.internet.update_data = (0, ())
+        elif self.opt == "server": # positions are sent as parts of the screen size, so client's window size doesn't matter
             self.internet.update_data = (
-                self.player2.move_direction,
-            )
-        elif self.opt == "server":
-            self.internet.update_data = (
-                self.gg,
-                self.cc,
-                self.streak,
-                self.ball.center / Vector(Window.size),
-                self.player1.y / Window.size[1],
-                self.player1.color,
-                self.player1.score,
-                self.player2.y / Window.size[1],
-                self.player2.color,
-                self.player2.score,
+                state.gg,
+                state.cc,
+                state.streak,
+                (state.ball.center_x / state.width, state.ball.center_y),
+                state.player1.y,
+                state.player1.scored,
+                state.player1.score,
+                state.player2.y,
+                state.player2.scored,
+                state.player2.score,
+                state.tick * 1000 // settings.fps, # time stamp in ms
+                self.inputs.applied,
             )
\ No newline at end of file
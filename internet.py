@@ -1,9 +1,12 @@
 import socket
 import json
+import time
 import os
 import platform
 
-from settings import settings, REQUEST_RECIVED, all
+import protocol
+from netcode import LinkStats
+from settings import settings, all
 
 
 class Internet:
@@ -16,27 +19,65 @@ class Internet:
         self.screen = None
         self.playing = False
         self.abandon_ = False
+        self.next_send = 0 # time when the next game frame is due
+        if initial: # lets game thread wake network thread up when it has something to send
+            self.wakeup, self.wakeup_signal = socket.socketpair()
+            self.wakeup.setblocking(False)
+            self.wakeup_signal.setblocking(False)
+        # game state is sent as deltas against what the client has already confirmed
+        self.snapshots = protocol.SnapshotEncoder() if self.outgoing == protocol.STATE else protocol.SnapshotDecoder()
+        self.link = LinkStats(f"Game link ({self.type_})") # quality of the in-game stream
 
     def abandon(self): # will trigger and abandon call on server / client thread
         self.abandon_ = True
+        self.wake()
+
+    def wake(self): # interrupts wait() of the network thread
+        try:
+            self.wakeup_signal.send(b"\0")
+        except BlockingIOError: # already full of unread signals
+            pass
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup.recv(settings.conn_data_limit):
+                pass
+        except BlockingIOError:
+            pass
+
+    # blocks until socket_ has a packet, wake() is called or the deadline passes, returns received data
+    def wait(self, selector, socket_, deadline, snapshots=None, link=None):
+        data = {}
+        for key, _ in selector.select(max(deadline - time.time(), 0)):
+            if key.fileobj is self.wakeup:
+                self.drain_wakeup()
+            else:
+                data = self.data_recive(socket_, snapshots, link)
+        return data
 
     def get_empty_socket(self):
         socket_ = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         socket_.settimeout(settings.socket_timeout)
         return socket_
 
-    def send(self, socket_, data, address):
-        data = {**data, **all}
-        data = json.dumps(data).encode(settings.encoding)
+    def send(self, socket_, data, address): # data is a lobby dict or an already encoded game frame
+        if not isinstance(data, bytes):
+            data = {**data, **all}
+            data = json.dumps(data).encode(settings.encoding)
         
         try:
             socket_.sendto(data, address)
         except Exception as e:
             settings.handle_error(e)
 
-    def recive(self, socket_): # returns both data and sender address
+    # returns both data and sender address, game frames are decoded with our own stream unless other snapshots are given
+    def recive(self, socket_, snapshots=None, link=None):
+        if snapshots is None:
+            snapshots, link = self.snapshots, self.link
         try:
             data, address = socket_.recvfrom(settings.conn_data_limit)
+            if protocol.is_frame(data): # in-game stream
+                return protocol.decode(data, snapshots, link), address
             data = data.decode(settings.encoding)
             if data:
                 data = json.loads(data)
@@ -48,8 +89,8 @@ class Internet:
             settings.handle_error(e)
         return {}, None
  
-    def data_recive(self, socket_): # returns only data
-        return self.recive(socket_)[0]
+    def data_recive(self, socket_, snapshots=None, link=None): # returns only data
+        return self.recive(socket_, snapshots, link)[0]
 
     def shutdown(self, obj): # shuts down socket / connection if it was on
         try:
@@ -59,20 +100,30 @@ class Internet:
     
     def event_dispatcher(self, key, value): # adds data to be send as a game content
         self.data.append((key, value))
+        self.wake() # events go out right away, not with the next tick
+
+    def send_due(self, t): # game frames are sent at fixed settings.tick_rate, regardless of fps and incoming packets
+        if t < self.next_send:
+            return False
+        self.next_send += 1 / settings.tick_rate
+        if self.next_send <= t: # we are late, don't send a burst
+            self.next_send = t + 1 / settings.tick_rate
+        return True
 
     def internet_action(self, data, send):
-        if self.data or self.update_data: # if we have data to send
-            send_ = self.data + [("UPDATE", self.update_data)]
-            send_ = {"GAME": send_}
-            send(send_)
-            self.data = []
-            self.update_data = tuple()
-        else: # inform him that we are still alive
-            send(REQUEST_RECIVED)
+        if self.data or self.send_due(time.time()): # empty frame informs him that we are still alive
+            # take them before encoding, events the game thread adds meanwhile go with the next frame
+            events, self.data = self.data, []
+            update, self.update_data = self.update_data, tuple()
+            send(protocol.encode(self.outgoing, events, update, self.snapshots, self.link))
+            self.broadcast(events, update)
 
         # if we have some data to recive
         if "GAME" in data and data["GAME"]:
-            self.screen.actions += data["GAME"]
+            self.screen.actions.extend(data["GAME"])
+
+    def broadcast(self, events, update): # same game frame for spectators, if there are any
+        pass
 
     def check_ip(ip, local):
         try:
@@ -89,12 +140,12 @@ class Internet:
         return None, local
 
     def get_devices():
+        return Internet.parse_devices(os.popen('arp -a').read(), platform.system())
+
+    def parse_devices(data, system): # ips from the output of arp -a
         devices = []
-        data = os.popen('arp -a')
-        data = data.read().split("\n\n") # splits interfaces
+        data = data.split("\n\n") # splits interfaces
 
-        system = platform.system()
-        
         # comment line below to scan every interface
         data = [data[-1]] # keep only local wifi (leave apps like hamachi)
 
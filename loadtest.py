@@ -0,0 +1,407 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import selectors
+import multiprocessing
+
+from settings import *
+from internet import Internet
+from netcode import LinkStats
+from bench import game_update
+import protocol
+
+
+# load generator over loopback: synthetic clients against a real Server / RoomServer,
+# or synthetic servers against a real Client, the tested side runs in its own process so its resources can be measured
+# python loadtest.py server --clients 300 --play 0.1 --abandon 0.2
+# python loadtest.py rooms --clients 200 --play 0.5
+# python loadtest.py client --servers 100 --vanish 0.1
+
+
+class Wire(Internet): # json and frame coding of Internet without server or client threads
+    type_ = "loadtest"
+    outgoing = protocol.INPUT
+
+
+def loopback_socket():
+    socket_ = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    socket_.setblocking(False)
+    socket_.bind(("127.0.0.1", 0))
+    return socket_
+
+
+def percentiles(values): # in ms
+    if not values:
+        return "-"
+    values = sorted(values)
+    pick = lambda part: values[min(int(part * len(values)), len(values) - 1)] * 1000
+    return f"p50 {pick(0.5):.1f} / p95 {pick(0.95):.1f} / p99 {pick(0.99):.1f} / max {values[-1] * 1000:.1f} ms ({len(values)})"
+
+
+def usage(pid): # (threads, sockets, rss in MB, cpu seconds) of that process, None where /proc isn't available
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            status = dict(line.split(":", 1) for line in file if ":" in line)
+        with open(f"/proc/{pid}/stat") as file:
+            stat = file.read().rsplit(")", 1)[1].split() # name may contain spaces
+        sockets = 0
+        for fd in os.listdir(f"/proc/{pid}/fd"):
+            try:
+                sockets += os.readlink(f"/proc/{pid}/fd/{fd}").startswith("socket:")
+            except OSError: # closed meanwhile
+                pass
+    except OSError:
+        return None
+    cpu = (int(stat[11]) + int(stat[12])) / os.sysconf("SC_CLK_TCK") # utime + stime
+    return int(status["Threads"]), sockets, int(status["VmRSS"].split()[0]) / 1024, cpu
+
+
+class Monitor: # samples the tested process once a second
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+        self.next_sample = 0
+
+    def sample(self, now):
+        if now < self.next_sample:
+            return
+        self.next_sample = now + 1
+        values = usage(self.pid)
+        if values is not None:
+            self.samples.append((now, *values))
+
+    def report(self):
+        if len(self.samples) < 2:
+            return {}
+        (t0, *_, cpu0), (t1, *_, cpu1) = self.samples[0], self.samples[-1]
+        return {
+            "threads": max(sample[1] for sample in self.samples),
+            "sockets": max(sample[2] for sample in self.samples),
+            "rss MB": round(max(sample[3] for sample in self.samples), 1),
+            "cpu %": round((cpu1 - cpu0) / (t1 - t0) * 100, 1),
+        }
+
+
+class HostScreen: # accepts the first player that asks, as the user would in AcceptPopup
+    def __init__(self, server):
+        self.server = server
+        self.actions = []
+        self.accept = None
+        self.ended = False
+
+    def add_action(self, name, data, *dt):
+        if name == "ADD" and not self.server.accept and not self.server.playing:
+            self.server.accept_game(data[1])
+        elif name == "LEAVE": # game is over, host goes back to his lobby
+            self.server.playing = False
+            self.server.client_address = None
+
+
+def serve(kind, addresses): # tested process, plays the host's game screen by feeding game states
+    from server import Server
+    from rooms import RoomServer
+
+    settings.HOST = "127.0.0.1"
+    server = RoomServer() if kind == "rooms" else Server()
+    screen = HostScreen(server) if kind == "server" else None
+    server.initialize("loadtest", screen)
+    addresses.put(server.address)
+    tick = 0
+    while server.working:
+        tick += 1
+        if server.playing:
+            server.update_data = game_update(tick)
+            screen.actions.clear() # received inputs, game screen would apply them
+        time.sleep(1 / settings.fps)
+
+
+class FakeClient: # one synthetic player, speaks the lobby and game protocol like Client.listen_server
+    def __init__(self, number, role, lobby, wire, stats, start):
+        self.socket_ = loopback_socket()
+        self.name = f"fake{number}"
+        self.role = role # browse, play or abandon
+        self.lobby = lobby
+        self.wire = wire
+        self.stats = stats
+        self.address = None # dedicated address server gave us
+        self.state = "join"
+        self.next_poll = start
+        self.sent_at = None # time of the packet whose answer we wait for
+        self.requested_at = None
+        self.give_up = None # abandoners leave the handshake at that time
+        self.snapshots = protocol.SnapshotDecoder()
+        self.link = LinkStats(self.name)
+        self.seq = 0
+
+    def send(self, data, address=None):
+        self.wire.send(self.socket_, data, address or self.address)
+
+    def leave(self, state): # socket is closed by the load loop
+        self.state = state
+        self.stats[state] = self.stats.get(state, 0) + 1
+
+    def gone(self):
+        return self.state in ["abandoned", "left"]
+
+    def poll(self, now, period):
+        match self.state:
+            case "join":
+                self.send(ALIVE, self.lobby)
+                self.sent_at = now
+                self.next_poll = now + 1 # retry if the answer got lost
+                return
+            case "browse":
+                self.send(ALIVE)
+                self.sent_at = now
+            case "request":
+                self.send({"client_name": self.name, **REQUEST_GAME})
+                self.requested_at = now
+                self.state = "waiting"
+                if self.role == "abandon":
+                    self.give_up = now + random.uniform(0, 2 * period)
+            case "waiting":
+                if self.give_up is not None and now >= self.give_up:
+                    self.send(ABANDON)
+                    self.leave("abandoned")
+                    return
+                self.send(WAITING)
+            case "playing": # inputs at tick rate
+                self.seq += 1
+                self.send(protocol.encode(protocol.INPUT, [], (self.seq, (random.choice([-1, 0, 1]),)), self.snapshots, self.link))
+                self.next_poll = now + 1 / settings.tick_rate
+                return
+        self.next_poll = now + period
+
+    def receive(self, data, now):
+        if data == LEAVE or data == ABANDON:
+            self.leave("left")
+            return
+        if "GAME" in data:
+            self.stats["frames"] = self.stats.get("frames", 0) + sum(1 for name, _ in data["GAME"] if name == "UPDATE")
+            return
+
+        opponent = data.pop("opponent", None)
+        match self.state:
+            case "join":
+                address = data.pop("address", None)
+                if address is not None and data.pop("server_name", None) is not None and data == REQUEST_RECIVED:
+                    self.stats["join"].append(now - self.sent_at)
+                    self.address = tuple(address)
+                    self.state = "browse" if self.role == "browse" else "request"
+                    self.next_poll = now
+            case "browse":
+                if self.sent_at is not None:
+                    self.stats["poll"].append(now - self.sent_at)
+                    self.sent_at = None
+            case "waiting":
+                if data == GAME_ACCEPTED:
+                    self.stats["game"].append(now - self.requested_at)
+                    self.stats["opponents"] += opponent is not None
+                    self.send(GAME_START)
+                    self.state = "playing"
+                    self.next_poll = now
+                elif data == BUSY and self.role == "abandon": # he closes the join popup
+                    self.send(ABANDON)
+                    self.leave("abandoned")
+                elif data == BUSY: # somebody else plays, we can only watch
+                    self.state = "browse"
+
+
+def load_server(args, wire): # synthetic clients against a real server, returns results
+    addresses = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(args.target, addresses), daemon=True)
+    process.start()
+    lobby = tuple(addresses.get(timeout=10))
+    monitor = Monitor(process.pid)
+
+    stats = {"join": [], "poll": [], "game": [], "opponents": 0}
+    selector = selectors.DefaultSelector()
+    start = time.time()
+    fakes = []
+    for number in range(args.clients):
+        role = random.choices(["play", "abandon", "browse"], [args.play, args.abandon, 1 - args.play - args.abandon])[0]
+        fake = FakeClient(number, role, lobby, wire, stats, start + args.ramp * number / args.clients)
+        selector.register(fake.socket_, selectors.EVENT_READ, fake)
+        fakes.append(fake)
+
+    def close(fake):
+        selector.unregister(fake.socket_)
+        fake.socket_.close()
+
+    end = start + args.duration
+    while (now := time.time()) < end:
+        for key, _ in selector.select(0.005):
+            fake = key.data
+            data, _ = wire.recive(fake.socket_, fake.snapshots, fake.link)
+            if data:
+                fake.receive(data, time.time())
+                if fake.gone():
+                    close(fake)
+        now = time.time()
+        for fake in fakes:
+            if not fake.gone() and now >= fake.next_poll:
+                fake.poll(now, args.poll)
+                if fake.gone():
+                    close(fake)
+        monitor.sample(now)
+
+    playing = [fake for fake in fakes if fake.state == "playing"]
+    results = {
+        "clients": {role: sum(1 for fake in fakes if fake.role == role) for role in ["browse", "play", "abandon"]},
+        "join": percentiles(stats["join"]),
+        "poll": percentiles(stats["poll"]),
+        "game": percentiles(stats["game"]),
+        "playing": len(playing),
+        "abandoned": stats.get("abandoned", 0),
+        "left": stats.get("left", 0),
+        "frames/s": round(stats.get("frames", 0) / args.duration, 1),
+        "links": [fake.link.summary() for fake in playing[:3]],
+        "server": monitor.report(),
+    }
+    for fake in fakes:
+        if not fake.gone():
+            close(fake)
+    process.terminate()
+    return results
+
+
+class BrowserScreen: # collects what Client shows in its servers list
+    def __init__(self):
+        self.actions = []
+
+    def add_action(self, name, data, *dt):
+        self.actions.append((name, data, time.time()))
+
+
+def browse(stop, results): # tested process, client listening for announced servers
+    from client import Client
+
+    settings.HOST = "127.0.0.1"
+    settings.announce = True
+    settings.announce_address = "127.0.0.1"
+    client = Client()
+    screen = BrowserScreen()
+    client.initialize("loadtest", screen)
+    stop.wait()
+    results.put(screen.actions)
+
+
+class FakeServer: # answers like Server's lobby, client gets our lobby socket as his dedicated one
+    def __init__(self, number, wire, vanish_at):
+        self.socket_ = loopback_socket()
+        self.address = self.socket_.getsockname()
+        self.name = f"fake{number}"
+        self.wire = wire
+        self.vanish_at = vanish_at # goes silent then, None if he stays
+        self.known = set() # client addresses we have told our dedicated address
+        self.announced = [] # times of our announcements
+
+    def silent(self, now):
+        return self.vanish_at is not None and now >= self.vanish_at
+
+    def announce(self, now):
+        self.announced.append(now)
+        data = {"announce": self.name, "port": self.address[1], "free": True}
+        self.wire.send(self.socket_, data, ("127.0.0.1", settings.announce_port))
+
+    def discovery(self, listed): # from the announcement client reacted to until he listed us
+        return listed - max(t for t in self.announced if t <= listed)
+
+    def receive(self, data, address):
+        if data == ALIVE or data == DISCOVER:
+            reply = {"server_name": self.name, **REQUEST_RECIVED}
+            if data == ALIVE and address not in self.known: # first contact, tell him where to talk to us
+                self.known.add(address)
+                reply["address"] = self.address
+            self.wire.send(self.socket_, reply, address)
+
+
+def load_client(args, wire): # synthetic servers against a real client, returns results
+    stop = multiprocessing.Event()
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=browse, args=(stop, queue), daemon=True)
+    process.start()
+    monitor = Monitor(process.pid)
+
+    start = time.time()
+    selector = selectors.DefaultSelector()
+    fakes = []
+    for number in range(args.servers):
+        vanish_at = start + random.uniform(args.duration / 3, args.duration * 2 / 3) if random.random() < args.vanish else None
+        fake = FakeServer(number, wire, vanish_at)
+        selector.register(fake.socket_, selectors.EVENT_READ, fake)
+        fakes.append(fake)
+
+    end = start + args.duration
+    next_announce = start
+    while (now := time.time()) < end:
+        for key, _ in selector.select(0.005):
+            fake = key.data
+            data, address = wire.recive(fake.socket_)
+            if data and not fake.silent(time.time()):
+                fake.receive(data, address)
+        now = time.time()
+        if now >= next_announce:
+            for fake in fakes:
+                if not fake.silent(now):
+                    fake.announce(now)
+            next_announce = now + settings.announce_interval
+        monitor.sample(now)
+
+    stop.set()
+    actions = queue.get(timeout=10)
+    process.join(1)
+    process.terminate()
+
+    added = {} # server name -> time it appeared in the list
+    for name, data, t in actions:
+        if name == "ADD":
+            added.setdefault(data[0], t)
+    rtts = [data[1] / 1000 for name, data, _ in actions if name == "PING" and data[1] is not None]
+    vanished = [fake for fake in fakes if fake.vanish_at is not None]
+    results = {
+        "servers": len(fakes),
+        "listed": len(added),
+        "discovery": percentiles([fake.discovery(added[fake.name]) for fake in fakes if fake.name in added]),
+        "ping": percentiles(rtts),
+        "vanished": len(vanished),
+        "removed": sum(1 for name, *_ in actions if name == "REMOVE"),
+        "client": monitor.report(),
+    }
+    for fake in fakes:
+        fake.socket_.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback load test of the lobby and game protocol.")
+    parser.add_argument("target", choices=["server", "rooms", "client"], help="what is tested: server.Server, rooms.RoomServer or client.Client")
+    parser.add_argument("--clients", type=int, default=200, help="synthetic clients against a server")
+    parser.add_argument("--play", type=float, default=0.1, help="part of the clients that request a game")
+    parser.add_argument("--abandon", type=float, default=0.2, help="part of the clients that abandon the handshake")
+    parser.add_argument("--servers", type=int, default=100, help="synthetic servers against a client")
+    parser.add_argument("--vanish", type=float, default=0.1, help="part of the servers that stop answering")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which clients are started")
+    parser.add_argument("--poll", type=float, default=settings.server_frequency, help="seconds between lobby packets of a client")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as json into this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    wire = Wire()
+    results = load_client(args, wire) if args.target == "client" else load_server(args, wire)
+    for name, value in results.items():
+        print(f"{name}: {value}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,36 +1,57 @@
 # python >= 3.10
 
+import os
+import json
+import time
+started = time.perf_counter() # startup is measured from here to the first drawn frame
+
 import kivy
 
 from kivy.app import App
-from kivy.uix.screenmanager import ScreenManager
 from kivy.lang import Builder
 from kivy.core.window import Window
+from kivy.clock import Clock
 
+from settings import settings
 from screens import *
 from widgets import *
 
 
 kivy.require("2.1.0")
+imported = time.perf_counter()
 Builder.load_file("style.kv")
+loaded = time.perf_counter()
 Window.size = (800, 600)
 
 class PongApp(App):
 
-    def build(self): 
-        sm = ScreenManager()
-        
-        sm.add_widget(MenuScreen(name="menu"))
-        sm.add_widget(ConnectScreen(name="connect"))
-        sm.add_widget(SettingsScreen(name="settings"))
-        sm.add_widget(NameScreen(name="name"))
-        sm.add_widget(ServerScreen(name="server"))
-        sm.add_widget(ClientScreen(name="client"))
-        sm.add_widget(GameScreen(name="game"))
-        sm.add_widget(PauseScreen(name="pause"))
-
+    def build(self): # other screens are built when they are first needed (see LazyScreenManager)
+        settings.resolve_host() # LAN games will need our address, it is looked up while the user goes through menus
+        sm = LazyScreenManager()
+        sm.get_screen("menu")
+        self.built = time.perf_counter()
         return sm
 
+    def on_start(self):
+        Clock.schedule_once(self.first_frame) # runs after the first frame has been drawn
+
+    def first_frame(self, *dt):
+        now = time.perf_counter()
+        self.startup = { # seconds of every startup phase
+            "imports": imported - started,
+            "kv": loaded - imported,
+            "build": self.built - loaded,
+            "first frame": now - started,
+        }
+        report = "Startup: " + ", ".join(f"{name} {value * 1000:.0f} ms" for name, value in self.startup.items())
+        path = os.environ.get("PONG_STARTUP") # logs can be turned on only after startup, so measuring is asked for here
+        if path:
+            print(report)
+            with open(path, "a") as file: # one json line per start, runs can be compared
+                file.write(json.dumps(self.startup) + "\n")
+        else:
+            settings.inform(report)
+
 
 if __name__ == '__main__':
-    PongApp().run()
\ No newline at end of file
+    PongApp().run()
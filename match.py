@@ -0,0 +1,154 @@
+from random import Random
+
+from settings import settings
+from engine import PongEngine
+
+
+# headless version of GameScreen's match flow (countdowns, serving, pausing, game end) for remote players
+# everything is counted in ticks of 1 / settings.fps, so the match runs the same regardless of wall time
+class Match:
+    def __init__(self, seed=None, recorder=None):
+        self.engine = PongEngine()
+        self.random = Random(seed)
+        self.recorder = recorder # recording.Recorder, if the match is recorded
+        self.rate = settings.fps
+        self.timers = {} # name -> [tick due, callback, callback data]
+        self.outbox = {1: [], 2: []} # events waiting to be sent to player1 / player2
+        self.inputs = [0, 0] # last move directions of player1 and player2
+        self.started = self.ended = False
+        self.cache_streak = 0
+        self.target = None
+
+    def dispatch(self, name, value_for): # value_for(slot) gives the event data for that player
+        if self.recorder is not None:
+            self.recorder.event(name, [value_for(slot) for slot in self.outbox])
+        for slot, events in self.outbox.items():
+            events.append((name, value_for(slot)))
+
+    def schedule(self, name, seconds, callback, *callback_data):
+        self.timers[name] = [self.engine.state.tick + round(seconds * self.rate), callback, callback_data]
+
+    def cancel(self, name):
+        self.timers.pop(name, None)
+
+    def tick(self):
+        state = self.engine.state
+        if self.recorder is not None:
+            self.recorder.begin(state)
+        state.tick += 1
+        for name, timer in list(self.timers.items()):
+            if timer[0] <= state.tick and self.timers.get(name) is timer: # due and not replaced by earlier callback
+                del self.timers[name]
+                timer[1](*timer[2])
+
+        if self.recorder is not None:
+            self.recorder.tick(state, self.inputs)
+        scorer = self.engine.step(self.inputs)
+        if scorer == 2: # went off the left side
+            self.turn_end(2, 1)
+        elif scorer == 1: # went off the right side
+            self.turn_end(1, -1)
+
+    def set_input(self, slot, direction):
+        self.inputs[slot - 1] = direction
+
+    def stamp(self): # simulation time in ms, sent with snapshots
+        return self.engine.state.tick * 1000 // self.rate
+
+    def update(self, slot): # game state as seen by that player, in the format of EventManager.send_data
+        state = self.engine.state
+        ball_x = state.ball.center_x / state.width
+        me, opponent = state.player1, state.player2
+        if slot == 2: # client always sees himself as server's player1, so swap the sides for player2
+            me, opponent = opponent, me
+            ball_x = 1 - ball_x
+        return (
+            state.gg,
+            state.cc,
+            state.streak,
+            (ball_x, state.ball.center_y),
+            me.y,
+            me.scored,
+            me.score,
+            opponent.y,
+            opponent.scored,
+            opponent.score,
+            self.stamp(),
+        )
+
+    def start_countdown(self, callback, callback_data, duration):
+        state = self.engine.state
+        if not state.cc: # if it wasn't paused during another countdown
+            self.cache_streak = state.streak
+        state.cc = True
+        state.streak = duration
+        self.schedule("countdown", 1, self.countdown, callback, callback_data)
+
+    def countdown(self, callback, callback_data):
+        state = self.engine.state
+        if state.streak == 0: # countdown timeout
+            state.streak = self.cache_streak
+            state.cc = False # mark countdown as finished
+            callback(*callback_data)
+        else:
+            state.streak -= 1
+            self.schedule("countdown", 1, self.countdown, callback, callback_data)
+
+    def start(self):
+        self.engine.reset()
+        self.start_countdown(self.serve, [self.random.choice([-1, 1])], settings.time_to_start)
+
+    def pause(self):
+        state = self.engine.state
+        if state.gg: # if during round
+            state.gg = False
+        elif state.cc: # if during countdown
+            state.cc = False
+            self.cancel("countdown")
+        else: # if serving a ball might be scheduled
+            self.cancel("serve")
+        self.dispatch("PAUSE_SCREEN", lambda slot: None)
+
+    def unpause(self):
+        if not self.started: # if game haven't started at all, call normal entry
+            self.start()
+        else:
+            self.start_countdown(self.unpause_helper, [], settings.time_to_unpause)
+        self.dispatch("UNPAUSE_SCREEN", lambda slot: None)
+
+    def unpause_helper(self):
+        state = self.engine.state
+        state.streak = self.cache_streak
+        state.gg = True # mark turn started
+        if self.target is not None and self.target[0] == "serve":
+            self.serve(*self.target[1:])
+        self.target = None # reset target call
+
+    def serve(self, direction):
+        settings.inform(f"Serving a ball (direction -> {direction})")
+        self.started = True
+        self.target = None # serve was done
+        angle = self.random.randint(-60, 60)
+        self.engine.serve(direction, angle)
+        if self.recorder is not None:
+            self.recorder.event("SERVE", [direction, angle])
+
+    def turn_end(self, scorer, direction):
+        settings.inform(f"Turn ended. (player{scorer} has won)")
+        self.engine.end_turn(scorer)
+
+        winner = self.engine.winner()
+        if winner:
+            self.end_game(winner)
+            return
+
+        self.target = ("serve", direction) # during turn end mark that we need to call serve again in case of pause right now
+        self.schedule("serve", 1, self.serve, direction) # start next turn after 1 s so players could prepare
+
+    def end_game(self, winner):
+        settings.inform(f"Game ended. (player{winner} has won)")
+        self.ended = True
+        self.timers.clear()
+        scores = [paddle.score for paddle in self.engine.state.players]
+        # each player gets: did he win, opponent's score, his score
+        self.dispatch("GAME END", lambda slot: [winner == slot, scores[2 - slot], scores[slot - 1]])
@@ -0,0 +1,245 @@
+import time
+from collections import deque
+
+from settings import settings
+import protocol
+
+
+class SnapshotBuffer: # remote entities are drawn a little in the past, between two received snapshots
+    def __init__(self, size=32):
+        self.snapshots = deque(maxlen=size) # (server time, values)
+        self.offsets = deque(maxlen=size) # local arrival time - server time
+
+    def clear(self):
+        self.snapshots.clear()
+        self.offsets.clear()
+
+    def push(self, stamp, values, arrival):
+        if self.snapshots and stamp <= self.snapshots[-1][0]: # keep them ordered
+            return
+        self.snapshots.append((stamp, values))
+        self.offsets.append(arrival - stamp)
+
+    def sample(self, now): # values interpolated for now - interpolation_delay, None if nothing received yet
+        if not self.snapshots:
+            return None
+        # the fastest recent packet tells how local clock maps to the server's one, jitter only adds to the rest
+        target = now - min(self.offsets) - settings.interpolation_delay
+
+        newer = None
+        for older in reversed(self.snapshots):
+            if older[0] <= target:
+                break
+            newer = older
+        else: # everything is newer than target
+            return self.snapshots[0][1]
+        if newer is None: # nothing newer, don't extrapolate
+            return older[1]
+
+        (t0, values0), (t1, values1) = older, newer
+        if any(abs(b - a) > settings.interpolation_snap for a, b in zip(values0, values1)): # teleport, like a new serve
+            return values1
+        part = (target - t0) / (t1 - t0)
+        return tuple(a + (b - a) * part for a, b in zip(values0, values1))
+
+
+class PaddlePredictor: # client side, own paddle moves right away and is corrected by server's authoritative position later
+    def __init__(self):
+        self.seq = 0 # number of our ticks, every tick makes one input
+        self.pending = deque(maxlen=256) # (seq, direction) not yet applied by the server
+
+    def clear(self):
+        self.seq = 0
+        self.pending.clear()
+
+    def predict(self, engine, paddle, active):
+        self.seq += 1
+        self.pending.append((self.seq, paddle.direction))
+        if active:
+            engine.move_paddle(paddle)
+
+    def history(self): # newest seq and directions of last unconfirmed inputs, resent in every packet in case some get lost
+        if not self.pending:
+            return tuple()
+        count = min(len(self.pending), settings.input_history)
+        return self.seq, tuple(self.pending[idx][1] for idx in range(len(self.pending) - count, len(self.pending)))
+
+    def correct(self, engine, paddle, server_y, acked, active): # acked is the last input server has applied
+        while self.pending and self.pending[0][0] <= acked:
+            self.pending.popleft()
+        paddle.y = server_y
+        if active: # replay inputs server doesn't know about yet
+            for _, direction in self.pending:
+                engine.move_paddle(paddle, direction)
+
+
+class InputStream: # server side, applies client's inputs in order, exactly one per tick
+    def __init__(self):
+        self.applied = 0 # last applied seq, acknowledged to the client
+        self.direction = 0
+        self.buffer = {} # seq -> direction, received but not applied yet
+
+    def receive(self, newest, directions):
+        for seq, direction in enumerate(directions, newest - len(directions) + 1):
+            if seq > self.applied:
+                self.buffer[seq] = direction
+        while len(self.buffer) > settings.input_buffer: # client got ahead of us, skip the oldest inputs
+            self.next()
+
+    def next(self): # direction for this tick, last one is repeated if client's input didn't come in time
+        if self.buffer:
+            self.applied = min(self.buffer)
+            self.direction = self.buffer.pop(self.applied)
+        return self.direction
+
+
+class Spectator: # server side, one watcher of the shared spectators' stream, gets every stride-th frame
+    def __init__(self):
+        self.stride = 1 # grows while he can't keep up, so slow watchers get fewer frames
+        self.skipped = 0
+        self.acked = None # newest frame he has confirmed
+        self.calm = 0 # frames since the stride last changed
+
+    def ack(self, seq): # called by protocol.decode, spectator acknowledges frames like a client does
+        if protocol.newer(seq, self.acked):
+            self.acked = seq
+
+    @staticmethod
+    def max_stride(): # frames must come well within connection_timeout, otherwise his client drops the game
+        return max(int(settings.tick_rate * settings.connection_timeout / 4), 1)
+
+    def slow_down(self):
+        self.stride = min(self.stride * 2, self.max_stride())
+        self.skipped = self.calm = 0
+
+    def wants(self, seq): # should frame seq be sent to him
+        self.calm += 1
+        if self.acked is not None:
+            lag = (seq - self.acked) % protocol.SEQ_MODULO
+            # acknowledgements don't keep up, since long enough for frames sent at the current stride to come back
+            if lag > self.stride + settings.spectator_lag * settings.tick_rate and self.calm > lag:
+                self.slow_down()
+        if self.stride > 1 and self.calm >= settings.tick_rate: # a second without trouble, try more frames
+            self.stride -= 1
+            self.calm = 0
+
+        self.skipped += 1
+        if self.skipped < self.stride:
+            return False
+        self.skipped = 0
+        return True
+
+
+CLOCK_MODULO = 1 << 32
+
+
+def clock(): # ms on a local clock, as sent in game frames, 0 means no stamp
+    return int(time.monotonic() * 1000) % CLOCK_MODULO or 1
+
+
+def elapsed(later, earlier): # ms between two clock() values, taking wrapping into account
+    return (later - earlier + CLOCK_MODULO // 2) % CLOCK_MODULO - CLOCK_MODULO // 2
+
+
+# quality of one connection, game frames carry (seq, clock, echoed clock of the peer, how long the echo was held)
+# rates are counted per second, rtt and jitter are smoothed like in TCP and RTP
+class LinkStats:
+    counters = ("packets_in", "bytes_in", "packets_out", "bytes_out", "lost", "reordered")
+
+    def __init__(self, name):
+        self.name = name # used in the log
+        self.seq = 0
+        self.highest = None # newest seq received
+        self.echo = None # (his clock, our clock when it came) of his newest frame, sent back for his rtt
+        self.transit = None # our clock - his clock of the previous frame, only its changes matter
+        self.pinged = None # our clock when a lobby ping was sent
+        self.rtt = None # ms
+        self.jitter = 0. # ms
+        self.second = None
+        self.current = dict.fromkeys(self.counters, 0)
+        self.last = dict(self.current) # counts of the last whole second
+        self.total = dict(self.current)
+
+    def count(self, name, value=1):
+        self.current[name] += value
+        self.total[name] += value
+
+    def roll(self, now): # moves to the next second, last whole second is logged every settings.stats_interval
+        second = now // 1000
+        if second == self.second:
+            return
+        if self.second is not None: # nothing came during a silent second in between
+            self.last = self.current if second == self.second + 1 else dict.fromkeys(self.counters, 0)
+        self.current = dict.fromkeys(self.counters, 0)
+        self.second = second
+        if second % settings.stats_interval == 0 and (self.last["packets_in"] or self.last["packets_out"]):
+            settings.inform(f"{self.name}: {self.text()}")
+
+    def outgoing(self): # stamps for a frame we send
+        now = clock()
+        self.seq = self.seq % (protocol.SEQ_MODULO - 1) + 1 # 0 is left for frames without stamps
+        if self.echo is None:
+            return self.seq, now, 0, 0
+        stamp, arrival = self.echo
+        return self.seq, now, stamp, min(elapsed(now, arrival), 0xFFFF)
+
+    def sent(self, size):
+        self.roll(clock())
+        self.count("packets_out")
+        self.count("bytes_out", size)
+
+    def received(self, size, seq, stamp, echo, held):
+        now = clock()
+        self.roll(now)
+        self.count("packets_in")
+        self.count("bytes_in", size)
+        if not seq: # shared frame, like the spectators' stream
+            return
+
+        if protocol.newer(seq, self.highest):
+            if self.highest is not None:
+                self.count("lost", (seq - self.highest) % protocol.SEQ_MODULO - 1)
+            self.highest = seq
+            self.echo = (stamp, now)
+            transit = elapsed(now, stamp)
+            if self.transit is not None: # RFC 3550 interarrival jitter
+                self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+            self.transit = transit
+        else: # late or duplicated, it was counted as lost when newer ones came
+            self.count("reordered")
+            if self.total["lost"] > 0:
+                self.count("lost", -1)
+
+        if echo: # he sent back our clock, minus the time he held it is the round trip
+            self.sample(elapsed(now, echo) - held)
+
+    def sample(self, rtt):
+        if rtt < 0:
+            return
+        self.rtt = rtt if self.rtt is None else self.rtt + (rtt - self.rtt) / 8
+
+    def ping(self): # lobby packet that will be answered, unanswered ones count as lost
+        if self.pinged is not None:
+            self.count("lost")
+        self.pinged = clock()
+
+    def pong(self):
+        if self.pinged is not None:
+            self.sample(elapsed(clock(), self.pinged))
+            self.pinged = None
+
+    def loss(self): # part of packets lost during the last second
+        expected = self.last["packets_in"] + max(self.last["lost"], 0)
+        return max(self.last["lost"], 0) / expected if expected else 0.
+
+    def text(self):
+        last = self.last
+        rtt = "-" if self.rtt is None else f"{self.rtt:.0f}"
+        return (
+            f"rtt {rtt} ms, jitter {self.jitter:.1f} ms, loss {self.loss() * 100:.1f} %, reordered {self.total['reordered']}, "
+            f"in {last['packets_in']}/s {last['bytes_in'] / 1000:.1f} kB/s, out {last['packets_out']}/s {last['bytes_out'] / 1000:.1f} kB/s"
+        )
+
+    def summary(self): # text of the last whole second, for screens
+        self.roll(clock())
+        return self.text()
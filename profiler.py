@@ -0,0 +1,113 @@
+import os
+import time
+from math import log10
+from collections import deque
+
+from settings import settings
+
+
+class RollingHistogram: # durations of the last `window` samples in log spaced bins, percentiles without sorting
+    per_decade = 20 # bins per power of ten, so a percentile is off by at most 12 %
+    low = 1e-6 # everything shorter falls into the first bin
+    decades = 6 # up to 1 s, everything longer falls into the last bin
+
+    def __init__(self, window):
+        self.bins = [0] * (self.per_decade * self.decades + 1)
+        self.samples = deque(maxlen=window) # bin of every sample, to remove it once it leaves the window
+
+    def bin(self, value):
+        if value <= self.low:
+            return 0
+        return min(int(log10(value / self.low) * self.per_decade) + 1, len(self.bins) - 1)
+
+    def add(self, value):
+        if len(self.samples) == self.samples.maxlen:
+            self.bins[self.samples[0]] -= 1
+        idx = self.bin(value)
+        self.samples.append(idx)
+        self.bins[idx] += 1
+
+    def percentile(self, part): # upper edge of the bin holding that part (0 - 1) of the samples, in seconds
+        if not self.samples:
+            return 0.
+        rank = part * len(self.samples)
+        total = 0
+        for idx, count in enumerate(self.bins):
+            total += count
+            if total >= rank:
+                return self.low * 10 ** (idx / self.per_decade)
+        return self.low * 10 ** self.decades
+
+
+# times phases of GameScreen.tick, call begin, then mark after every phase and end
+# Kivy draws the canvas in its event loop after the tick, draw_started / draw_ended (Window's on_draw / on_flip) time it,
+# so "draw" is a part of "frame" but not of "work"
+class FrameProfiler:
+    percentiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, enabled=False, budget=1 / 60, window=600):
+        self.enabled = enabled
+        self.budget = budget # time one frame may take, 1 / fps
+        self.window = window
+        self.histograms = {} # phase -> RollingHistogram, "frame" is time between two ticks, "work" time spent in a tick
+        self.frames = 0
+        self.missed = 0 # ticks that came more than half a frame late
+        self.over = 0 # ticks whose work alone took longer than a frame
+        self.started = self.last = self.previous = self.drawing = None
+
+    def add(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = RollingHistogram(self.window)
+        histogram.add(value)
+
+    def begin(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.previous is not None:
+            frame = now - self.previous
+            self.add("frame", frame)
+            if frame > self.budget * 1.5:
+                self.missed += 1
+        self.previous = self.started = self.last = now
+
+    def mark(self, name): # phase that has just ended
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.add(name, now - self.last)
+        self.last = now
+
+    def draw_started(self, *args): # handlers bound to Window run before it draws / flips
+        if self.enabled:
+            self.drawing = time.perf_counter()
+
+    def draw_ended(self, *args):
+        if self.enabled and self.drawing is not None:
+            self.add("draw", time.perf_counter() - self.drawing)
+            self.drawing = None
+
+    def end(self):
+        if not self.enabled:
+            return
+        work = self.last - self.started
+        self.add("work", work)
+        if work > self.budget:
+            self.over += 1
+        self.frames += 1
+
+    def report(self): # lines with percentiles of every phase in ms
+        header = "p" + " / p".join(str(round(part * 100)) for part in self.percentiles)
+        lines = [f"{self.frames} frames, {self.missed} missed, {self.over} over {self.budget * 1000:.1f} ms budget ({header} ms)"]
+        for name, histogram in self.histograms.items():
+            values = " / ".join(f"{histogram.percentile(part) * 1000:.2f}" for part in self.percentiles)
+            lines.append(f"{name}: {values}")
+        return "\n".join(lines)
+
+    def dump(self, name): # writes the report into settings.profile_dir, returns the file path
+        os.makedirs(settings.profile_dir, exist_ok=True)
+        path = os.path.join(settings.profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.txt")
+        with open(path, "w") as file:
+            file.write(self.report() + "\n")
+        return path
@@ -0,0 +1,178 @@
+import struct
+import zlib
+from collections import OrderedDict
+
+from settings import settings
+
+
+# binary framing of the in-game stream, lobby handshake stays in json (see Internet.send)
+# frame: header | link stamps | events count | events | update (optional, rest of the frame)
+
+MAGIC = b"PG"
+VERSION = 5
+HEADER = struct.Struct("!2sBBI") # magic, version, opcode, key tag
+LINK = struct.Struct("!HIIH") # frame seq, sender's clock in ms, echoed clock of the receiver, ms it was held (see netcode.LinkStats)
+TAG = zlib.crc32(settings.key.encode(settings.encoding))
+
+# opcodes
+STATE = 1 # server -> client, update is a game state snapshot, full or delta
+INPUT = 2 # client -> server, update is client's last paddle inputs and the last snapshot he has
+
+COUNT = struct.Struct("!B")
+INPUT_UPDATE = struct.Struct("!HIB") # acknowledged snapshot, seq of the newest input, number of inputs, then their directions
+
+# snapshot: seq | baseline seq | fields mask | server time in ms | last applied input | fields present in the mask
+SNAPSHOT = struct.Struct("!HHHII")
+KEYFRAME = 1 << 15 # mask flag, snapshot holds all fields and has no baseline
+SEQ_MODULO = 1 << 16
+FIELDS = [ # gg, cc, streak, ball center x, ball center y, player1 y, player1 scored, player1 score, player2 y, player2 scored, player2 score
+    struct.Struct(f) for f in ["!?", "!?", "!H", "!f", "!f", "!f", "!?", "!H", "!f", "!?", "!H"]
+]
+FULL = struct.Struct("!" + "".join(field.format[1:] for field in FIELDS))
+
+EVENTS = ["PAUSE", "PAUSE_SCREEN", "UNPAUSE", "UNPAUSE_SCREEN", "GAME END"] # event code is its index
+EVENT_CODES = {name: code for code, name in enumerate(EVENTS)}
+EVENT_DATA = { # events that carry data
+    "GAME END": struct.Struct("!?HH"), # did receiver win, opponent's score, receiver's score
+}
+
+
+def is_frame(data):
+    return data[:2] == MAGIC
+
+
+def newer(seq, other): # seq is later than other, taking wrapping into account
+    return other is None or 0 < (seq - other) % SEQ_MODULO < SEQ_MODULO // 2
+
+
+def flatten(update): # game state tuple (as in EventManager.send_data, without time stamp and input ack) -> tuple of FIELDS values
+    gg, cc, streak, (ball_x, ball_y), *rest = update
+    return FULL.unpack(FULL.pack(gg, cc, streak, ball_x, ball_y, *rest)) # round the same way receiver will see it
+
+
+def unflatten(fields):
+    gg, cc, streak, ball_x, ball_y, *rest = fields
+    return (gg, cc, streak, (ball_x, ball_y), *rest)
+
+
+class SnapshotEncoder: # server side, sends deltas against the last snapshot client acknowledged
+    def __init__(self):
+        self.seq = 0
+        self.acked = None
+        self.history = OrderedDict() # seq -> fields of snapshots that might still be acknowledged
+        self.since_keyframe = 0
+
+    def ack(self, seq):
+        if seq in self.history and newer(seq, self.acked):
+            self.acked = seq
+
+    def pack(self, update):
+        *update, stamp, acked = update
+        fields = flatten(update)
+        stamp %= 1 << 32
+        self.seq = (self.seq + 1) % SEQ_MODULO
+        self.history[self.seq] = fields
+        while len(self.history) > settings.snapshot_history:
+            self.history.popitem(last=False)
+
+        baseline = self.history.get(self.acked)
+        self.since_keyframe += 1
+        if baseline is None or self.since_keyframe >= settings.keyframe_interval:
+            self.since_keyframe = 0
+            return SNAPSHOT.pack(self.seq, self.seq, KEYFRAME, stamp, acked) + FULL.pack(*fields)
+
+        mask = 0
+        parts = []
+        for idx, (field, value) in enumerate(zip(FIELDS, fields)):
+            if value != baseline[idx]:
+                mask |= 1 << idx
+                parts.append(field.pack(value))
+        return SNAPSHOT.pack(self.seq, self.acked, mask, stamp, acked) + b"".join(parts)
+
+
+class SnapshotDecoder: # client side, rebuilds full snapshots and remembers the newest one to acknowledge
+    def __init__(self):
+        self.latest = None
+        self.history = OrderedDict() # seq -> fields
+
+    def unpack(self, data, offset): # returns game state tuple or None if snapshot is stale or can't be rebuilt
+        seq, baseline, mask, stamp, acked = SNAPSHOT.unpack_from(data, offset)
+        offset += SNAPSHOT.size
+        if not newer(seq, self.latest): # reordered or duplicated packet
+            return None
+
+        if mask & KEYFRAME:
+            fields = FULL.unpack_from(data, offset)
+        else:
+            if baseline not in self.history: # we have lost the baseline, wait for a keyframe
+                return None
+            fields = list(self.history[baseline])
+            for idx, field in enumerate(FIELDS):
+                if mask & (1 << idx):
+                    (fields[idx],) = field.unpack_from(data, offset)
+                    offset += field.size
+            fields = tuple(fields)
+
+        self.latest = seq
+        self.history[seq] = fields
+        while len(self.history) > 2 * settings.snapshot_history:
+            self.history.popitem(last=False)
+        return unflatten(fields) + (stamp, acked)
+
+
+# link measures connection quality, frames encoded without it carry no stamps
+def encode(opcode, events, update, snapshots, link=None):
+    stamps = link.outgoing() if link is not None else (0, 0, 0, 0)
+    parts = [HEADER.pack(MAGIC, VERSION, opcode, TAG), LINK.pack(*stamps), COUNT.pack(len(events))]
+    for name, value in events:
+        parts.append(COUNT.pack(EVENT_CODES[name]))
+        if name in EVENT_DATA:
+            parts.append(EVENT_DATA[name].pack(*value))
+    if update:
+        if opcode == STATE:
+            parts.append(snapshots.pack(update))
+        else:
+            latest = snapshots.latest
+            newest, directions = update
+            parts.append(INPUT_UPDATE.pack(latest if latest is not None else 0, newest, len(directions)))
+            parts.append(struct.pack(f"!{len(directions)}b", *directions))
+    frame = b"".join(parts)
+    if link is not None:
+        link.sent(len(frame))
+    return frame
+
+
+# returns game actions in the same shape as json {"GAME": [...]} packets, empty dict for foreign frames
+def decode(data, snapshots, link=None):
+    magic, version, opcode, tag = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or tag != TAG or opcode not in [STATE, INPUT]:
+        return {}
+    if link is not None:
+        link.received(len(data), *LINK.unpack_from(data, HEADER.size))
+
+    offset = HEADER.size + LINK.size
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+
+    actions = []
+    for _ in range(count):
+        (code,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        name = EVENTS[code]
+        value = None
+        if name in EVENT_DATA:
+            value = list(EVENT_DATA[name].unpack_from(data, offset))
+            offset += EVENT_DATA[name].size
+        actions.append((name, value))
+
+    if offset < len(data):
+        if opcode == STATE:
+            update = snapshots.unpack(data, offset)
+            if update is not None:
+                actions.append(("UPDATE", update))
+        else:
+            acked, newest, count = INPUT_UPDATE.unpack_from(data, offset)
+            snapshots.ack(acked)
+            directions = struct.unpack_from(f"!{count}b", data, offset + INPUT_UPDATE.size)
+            actions.append(("UPDATE", (newest, directions)))
+    return {"GAME": actions}
@@ -0,0 +1,223 @@
+import os
+import mmap
+import json
+import time
+import struct
+from bisect import bisect_right
+from contextlib import contextmanager
+
+from settings import settings
+from engine import PongEngine
+
+
+# binary log of a match, enough to simulate it again tick by tick
+# file: header | settings json | records | index record | trailer
+# every record starts with its kind, keyframes hold the state the tick record after them is applied to
+
+MAGIC = b"PGR"
+VERSION = 1
+HEADER = struct.Struct("!3sBQH") # magic, version, seed, length of settings json
+TRAILER = struct.Struct("!Q3s") # offset of the index record, b"END" (missing if recording wasn't closed)
+KIND = struct.Struct("!B")
+COUNT = struct.Struct("!I")
+
+# record kinds
+TICK = 0 # simulation advanced by one tick with these inputs
+FLAGS = 1 # turn / countdown state changed by match flow outside the engine
+EVENT = 2 # named event with json data, SERVE and RESIZE change the simulation, the rest is informative
+KEYFRAME = 3 # whole game state
+INDEX = 4 # (tick, offset) of every keyframe
+
+RECORDS = {
+    TICK: struct.Struct("!bb"), # player1 and player2 move direction
+    FLAGS: struct.Struct("!??H"), # gg, cc, streak
+    EVENT: struct.Struct("!BH"), # length of the name, length of the data
+    KEYFRAME: struct.Struct("!Id4d??H" + "dd?H" * 2), # tick, width, ball x, y, velocity x, y, gg, cc, streak, paddles: y, speed, scored, score
+    INDEX: COUNT,
+}
+INDEX_ENTRY = struct.Struct("!IQ")
+
+SETTINGS = [ # settings that change the simulation
+    "fps", "speed", "speedup", "moveSpeed", "botMoveSpeed", "bot_reaction", "bot_error",
+    "rounds_to_win", "time_to_start", "time_to_unpause",
+]
+
+
+def path_for(name): # new recording file in settings.record_dir
+    os.makedirs(settings.record_dir, exist_ok=True)
+    return os.path.join(settings.record_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.pgr")
+
+
+def pack_state(state):
+    ball = state.ball
+    values = [state.tick, state.width, ball.x, ball.y, ball.velocity_x, ball.velocity_y, state.gg, state.cc, state.streak]
+    for paddle in state.players:
+        values += [paddle.y, paddle.speed, paddle.scored, paddle.score]
+    return RECORDS[KEYFRAME].pack(*values)
+
+
+def unpack_state(engine, values):
+    state = engine.state
+    state.tick, width, *ball, state.gg, state.cc, state.streak = values[:9]
+    engine.resize(width)
+    state.ball.x, state.ball.y, state.ball.velocity_x, state.ball.velocity_y = ball
+    for idx, paddle in enumerate(state.players):
+        paddle.y, paddle.speed, paddle.scored, paddle.score = values[9 + 4 * idx:13 + 4 * idx]
+
+
+class Recorder: # written by whoever computes the game, call begin and tick once per tick
+    def __init__(self, path, seed):
+        self.file = open(path, "wb")
+        self.offset = 0
+        self.ticks = 0
+        self.flags = None
+        self.keyframes = [] # (tick, offset)
+
+        data = json.dumps({name: getattr(settings, name) for name in SETTINGS}).encode(settings.encoding)
+        self.write(HEADER.pack(MAGIC, VERSION, seed, len(data)) + data)
+
+    def write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+
+    def record(self, kind, *values):
+        self.write(KIND.pack(kind) + RECORDS[kind].pack(*values))
+
+    def begin(self, state): # state at the start of the tick, before its tick counter is advanced
+        if self.ticks % settings.record_keyframe_interval == 0:
+            self.keyframes.append((state.tick, self.offset))
+            self.write(KIND.pack(KEYFRAME) + pack_state(state))
+            self.flags = (state.gg, state.cc, state.streak)
+
+    def tick(self, state, inputs): # inputs the tick is stepped with
+        flags = (state.gg, state.cc, state.streak)
+        if flags != self.flags:
+            self.flags = flags
+            self.record(FLAGS, *flags)
+        self.ticks += 1
+        self.record(TICK, *inputs)
+
+    def event(self, name, data):
+        name = name.encode(settings.encoding)
+        data = json.dumps(data, default=str).encode(settings.encoding)
+        self.write(KIND.pack(EVENT) + RECORDS[EVENT].pack(len(name), len(data)) + name + data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        index = self.offset
+        self.record(INDEX, len(self.keyframes))
+        self.write(b"".join(INDEX_ENTRY.pack(*keyframe) for keyframe in self.keyframes))
+        self.write(TRAILER.pack(index, b"END"))
+        self.file.close()
+
+
+# plays a recording back from a memory mapped file, replayed match uses the settings it was recorded with
+# engine reads the global settings, so they are switched to the recorded ones only while the replay simulates
+class Replay:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.seed, length = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a recording of this version")
+        self.settings = json.loads(self.data[HEADER.size:HEADER.size + length].decode(settings.encoding))
+
+        self.start = HEADER.size + length
+        self.end = len(self.data)
+        self.keyframes = self.read_index()
+        with self.recorded_settings():
+            self.engine = PongEngine()
+        self.offset = self.start
+
+    @contextmanager
+    def recorded_settings(self): # game's own settings are back once the block ends
+        previous = {name: getattr(settings, name) for name in self.settings}
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        try:
+            yield
+        finally:
+            for name, value in previous.items():
+                setattr(settings, name, value)
+
+    def read_index(self): # from the trailer, or by scanning the records if recording wasn't closed
+        if self.end - self.start >= TRAILER.size:
+            index, end = TRAILER.unpack_from(self.data, self.end - TRAILER.size)
+            if end == b"END":
+                self.end = index
+                (count,) = COUNT.unpack_from(self.data, index + KIND.size)
+                first = index + KIND.size + COUNT.size
+                return [INDEX_ENTRY.unpack_from(self.data, first + idx * INDEX_ENTRY.size) for idx in range(count)]
+        return [(values[0], offset) for kind, values, offset, _ in self.records(self.start) if kind == KEYFRAME]
+
+    def records(self, offset): # yields (kind, values, offset of the record, offset of the next one)
+        while offset < self.end:
+            try:
+                (kind,) = KIND.unpack_from(self.data, offset)
+                values = RECORDS[kind].unpack_from(self.data, offset + KIND.size)
+                end = offset + KIND.size + RECORDS[kind].size
+                if kind == EVENT:
+                    name_end = end + values[0]
+                    name = self.data[end:name_end].decode(settings.encoding)
+                    end = name_end + values[1]
+                    values = (name, json.loads(self.data[name_end:end].decode(settings.encoding)))
+            except (struct.error, KeyError, ValueError): # cut off while writing
+                return
+            yield kind, values, offset, end
+            offset = end
+
+    def load(self, offset): # restores the keyframe at offset and continues after it
+        unpack_state(self.engine, RECORDS[KEYFRAME].unpack_from(self.data, offset + KIND.size))
+        self.offset = offset + KIND.size + RECORDS[KEYFRAME].size
+
+    def seek(self, tick): # jump to the last keyframe before tick and simulate the rest
+        idx = bisect_right(self.keyframes, (tick, self.end)) - 1
+        if idx < 0:
+            raise ValueError(f"Tick {tick} is before the recording")
+        keyframe_tick, offset = self.keyframes[idx]
+        self.load(offset)
+        return self.play(tick - keyframe_tick)
+
+    # simulates that many ticks (all if None) from the current position, returns number of simulated ticks
+    # keyframes on the way are skipped, so the state is only what the simulation makes of the inputs
+    def play(self, ticks=None):
+        with self.recorded_settings():
+            engine = self.engine
+            state = engine.state
+            played = 0
+            for kind, values, _, end in self.records(self.offset):
+                if kind == TICK:
+                    if ticks is not None and played >= ticks:
+                        break
+                    state.tick += 1
+                    scorer = engine.step(values)
+                    if scorer:
+                        engine.end_turn(scorer)
+                    played += 1
+                elif kind == FLAGS:
+                    state.gg, state.cc, state.streak = values
+                elif kind == EVENT:
+                    name, data = values
+                    if name == "SERVE":
+                        engine.serve(*data)
+                    elif name == "RESIZE":
+                        engine.resize(data)
+                self.offset = end
+            return played
+
+    def verify(self): # replays everything and returns ticks where simulation differs from the recorded keyframes
+        if not self.keyframes:
+            return []
+        desyncs = []
+        self.load(self.keyframes[0][1])
+        for tick, offset in self.keyframes[1:]:
+            self.play(tick - self.engine.state.tick)
+            expected = self.data[offset + KIND.size:offset + KIND.size + RECORDS[KEYFRAME].size]
+            if pack_state(self.engine.state) != expected:
+                desyncs.append(tick)
+                self.load(offset) # carry on from the recorded state to find further desyncs
+        return desyncs
+
+    def close(self):
+        self.data.close()
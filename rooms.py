@@ -0,0 +1,250 @@
+import sys
+import time
+import signal
+import argparse
+from random import getrandbits
+from threading import Event
+
+from settings import *
+from server import Server
+from match import Match
+from netcode import InputStream, LinkStats
+from recording import Recorder, path_for
+import protocol
+
+
+class Room: # one match between two remote clients, ticked by RoomServer
+    max_catch_up = 5 # ticks run at once when the loop was late, older ones are skipped
+
+    def __init__(self, number, first, second):
+        self.number = number
+        self.connections = {1: first, 2: second} # first plays as player1, second as player2
+        seed = getrandbits(63)
+        self.match = Match(seed, Recorder(path_for(f"room{number}"), seed) if settings.record else None)
+        self.inputs = {1: InputStream(), 2: InputStream()}
+        self.ready = set() # slots that confirmed GAME_START
+        self.playing = False
+        self.next_tick = self.next_send = 0
+
+    def opponent(self, slot):
+        return self.connections[3 - slot]
+
+    def start(self, t1):
+        settings.inform(f"Room {self.number} started.")
+        self.playing = True
+        self.next_tick = t1
+        self.match.start()
+
+    def receive(self, slot, actions):
+        for name, data in actions:
+            match name:
+                case "UPDATE" if data:
+                    self.inputs[slot].receive(*data)
+                case "PAUSE":
+                    self.match.pause()
+                case "UNPAUSE":
+                    self.match.unpause()
+
+    def update(self, t1, send): # runs ticks that are due and sends the state at tick_rate, returns when to be called again
+        period = 1 / self.match.rate
+        ticks = 0
+        while self.next_tick <= t1 and ticks < self.max_catch_up:
+            for slot, inputs in self.inputs.items():
+                self.match.set_input(slot, inputs.next())
+            self.match.tick()
+            self.next_tick += period
+            ticks += 1
+        if self.next_tick <= t1: # too late to catch up
+            self.next_tick = t1 + period
+
+        if t1 >= self.next_send:
+            self.next_send += 1 / settings.tick_rate
+            if self.next_send <= t1: # we are late, don't send a burst
+                self.next_send = t1 + 1 / settings.tick_rate
+            for slot, connection in self.connections.items():
+                events, self.match.outbox[slot] = self.match.outbox[slot], []
+                update = self.match.update(slot) + (self.inputs[slot].applied,)
+                frame = protocol.encode(protocol.STATE, events, update, connection.snapshots, connection.link)
+                send(connection.socket_, frame, connection.address)
+        return min(self.next_tick, self.next_send)
+
+
+# lobby that pairs clients requesting a game into rooms, all served from the single Server.listen loop
+class RoomServer(Server):
+    def reset(self, initial=False):
+        super().reset(initial)
+        self.rooms = {} # number -> Room
+        self.queue = [] # connections waiting for an opponent
+        self.room_count = 0
+        self.closed = Event() # set when listen loop said goodbye to every client
+
+    def new_client(self, selector, connections, address):
+        connection = super().new_client(selector, connections, address)
+        connection.snapshots = protocol.SnapshotEncoder()
+        connection.link = LinkStats(f"Client {address}")
+        return connection
+
+    def pair(self):
+        while len(self.queue) >= 2:
+            first, second = self.queue.pop(0), self.queue.pop(0)
+            self.room_count += 1
+            room = Room(self.room_count, first, second)
+            first.room, first.slot = room, 1
+            second.room, second.slot = room, 2
+            self.rooms[room.number] = room
+            settings.inform(f"Room {room.number} created for {first.address} and {second.address}.")
+
+    def close_room(self, room, leaving):
+        settings.inform(f"Room {room.number} closed.")
+        del self.rooms[room.number]
+        if room.match.recorder is not None:
+            room.match.recorder.close()
+        for slot, connection in room.connections.items():
+            connection.room = None
+            if connection is leaving or room.match.ended:
+                continue
+            if slot in room.ready: # he is already playing, let him know his opponent left
+                self.send(connection.socket_, ABANDON, connection.address)
+            else: # still in handshake, he can wait for somebody else
+                self.queue.insert(0, connection)
+        self.pair()
+
+    def handle_client(self, connection, data, t1):
+        address = connection.address
+        room = connection.room
+        def send(data):
+            self.send(connection.socket_, data, address)
+
+        timeout = settings.connection_timeout if room is not None and room.playing else settings.lobby_timeout()
+        if t1 - connection.t0 > timeout:
+            settings.inform(f"Connection timeout ({address}).")
+            return True
+
+        if data == LEAVE:
+            settings.inform(f"Client left.")
+            return True
+
+        elif data == ABANDON:
+            settings.inform(f"Client {address} aborted.")
+            send(REQUEST_RECIVED)
+            return True
+
+        elif room is not None and room.playing:
+            if "GAME" in data:
+                room.receive(connection.slot, data["GAME"])
+
+        elif room is not None and "GAME" in data: # he already plays, keep him alive until opponent is ready
+            send(protocol.encode(protocol.STATE, [], (), connection.snapshots, connection.link))
+
+        elif data == ALIVE: # he tells us that he is still here
+            send({"server_name": self.server_name, **REQUEST_RECIVED})
+
+        elif data == WAITING:
+            if room is not None: # opponent found
+                send({"opponent": room.opponent(connection.slot).client_name, **GAME_ACCEPTED})
+            else:
+                send(REQUEST_RECIVED)
+
+        elif room is not None and data == GAME_START: # client is ready for a game
+            room.ready.add(connection.slot)
+            if len(room.ready) == 2:
+                room.start(t1)
+
+        elif "client_name" in data:
+            client_name = data.pop("client_name")
+
+            if data == REQUEST_GAME and room is None and connection not in self.queue:
+                settings.inform(f"Client {address} wants to join a game.")
+                connection.client_name = client_name
+                send(REQUEST_RECIVED)
+                self.queue.append(connection)
+                self.pair()
+
+        if data: # there was an interaction with client, reset timer
+            connection.t0 = t1
+        connection.polled = t1
+        return None
+
+    def service(self, t1):
+        timeout = settings.socket_timeout
+        for room in list(self.rooms.values()):
+            if room.playing:
+                next_tick = room.update(t1, self.send)
+                timeout = min(timeout, max(next_tick - time.time(), 0))
+        return timeout
+
+    def close_client(self, selector, connections, connection, error):
+        del connections[connection.address]
+        selector.unregister(connection.socket_)
+        self.clients.discard(connection.address) # he may connect again
+        if connection in self.queue:
+            self.queue.remove(connection)
+        if connection.room is not None:
+            self.close_room(connection.room, connection)
+        if not self.working: # planned exit
+            self.send(connection.socket_, LEAVE, connection.address)
+        self.shutdown(connection.socket_)
+
+    def listen(self):
+        try:
+            super().listen()
+        finally:
+            self.closed.set()
+
+    def stop(self): # lets the listen loop send LEAVE to every client before sockets are closed
+        self.working = False
+        self.wake()
+        self.closed.wait(settings.connection_timeout)
+        self.reset()
+
+    def status(self):
+        playing = sum(room.playing for room in list(self.rooms.values()))
+        return f"{len(self.clients)} clients, {len(self.queue)} waiting, {len(self.rooms)} rooms ({playing} playing)"
+
+
+# dedicated server without a window, both players of every room are remote clients
+# python rooms.py --announce --status 60
+def main():
+    parser = argparse.ArgumentParser(description="Dedicated server: every two players that join get their own room with an authoritative game.")
+    parser.add_argument("--name", default="Pong rooms", help="server name shown in clients' lists")
+    parser.add_argument("--host", help="address to bind, this PC's LAN address by default")
+    parser.add_argument("--announce", nargs="?", const=settings.announce_address, metavar="ADDRESS",
+                        help=f"announce the server to clients, to {settings.announce_address} or the given multicast group")
+    parser.add_argument("--rounds", type=int, default=settings.rounds_to_win, help="points needed to win a match")
+    parser.add_argument("--record", action="store_true", help=f"save every match into {settings.record_dir}")
+    parser.add_argument("--status", type=float, default=60, help="seconds between status lines, 0 turns them off")
+    parser.add_argument("--quiet", action="store_true", help="don't log every connection and room event")
+    parser.add_argument("--debug", action="store_true", help="print errors that are bypassed")
+    args = parser.parse_args()
+
+    if args.host:
+        settings.HOST = args.host
+    if args.announce:
+        settings.announce = True
+        settings.announce_address = args.announce
+    settings.rounds_to_win = args.rounds
+    settings.record = args.record
+    settings.verbose = not args.quiet
+    settings.debug = args.debug
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # service managers stop us the same way as ctrl+c
+
+    server = RoomServer()
+    server.initialize(args.name, None)
+    if not server.working:
+        sys.exit(f"Unable to create a server at {settings.HOST}, ports {settings.PORT}-{settings.MAX_PORT} are taken.")
+    print(f"Serving {args.name!r} at {server.address}.", flush=True)
+
+    next_status = time.time() + args.status
+    try:
+        while server.working:
+            time.sleep(1)
+            if args.status and time.time() >= next_status:
+                print(server.status(), flush=True)
+                next_status += args.status
+    except KeyboardInterrupt:
+        print("Shutting down.", flush=True)
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
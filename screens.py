@@ -1,19 +1,20 @@
 from kivy.properties import NumericProperty, ObjectProperty, ReferenceListProperty, BooleanProperty, StringProperty, ColorProperty, NumericProperty, ListProperty
-from kivy.vector import Vector
 from kivy.core.window import Window
-from kivy.uix.screenmanager import Screen
+from kivy.uix.screenmanager import Screen, ScreenManager
 from kivy.clock import Clock
 
-from random import randint, choice
+from random import Random, getrandbits
 from functools import partial
 from _thread import *
 
 from settings import settings
-from widgets import ErrorPopup, AcceptPopup, JoinPopup, Paddle
+from widgets import ErrorPopup, AcceptPopup, JoinPopup
+from engine import PongEngine
+from netcode import SnapshotBuffer, PaddlePredictor, InputStream
 from bot import Bot
-from server import Server
-from client import Client
-from helpers import EventManager
+from recording import Recorder, path_for
+from profiler import FrameProfiler
+from helpers import EventManager, ActionQueue
 
 
 class MyScreen():
@@ -23,7 +24,7 @@ class MyScreen():
     # ticking administrates events
 
     def add_action(self, name, data, *dt):
-        self.actions.append((name, data))
+        self.actions.put(name, data)
 
 
 class MenuScreen(Screen, MyScreen):
@@ -75,12 +76,13 @@ class ServerScreen(Screen, MyScreen):
             if self.ticking is not None:
                 self.ticking.cancel()
         else:
+            from server import Server # network is loaded only once LAN games are used
             self.server = Server()
             self.accept = None
             self.ticking = None
         self.dots = 0
         self.clients_list = []
-        self.actions = [] # all must be O(1)
+        self.actions = ActionQueue()
         self.time = settings.waiting_timeout # shut down the server after specified time if is doesn't start a game
 
     def initialize(self, server_name):
@@ -91,6 +93,8 @@ class ServerScreen(Screen, MyScreen):
             self.manager.current = "connect"
             ErrorPopup("Server error", "Unable to create server, try again later.").open()
             self.reset()
+        elif settings.host_fallback:
+            ErrorPopup("Network error", "Your LAN address wasn't found, the server is reachable only from this PC.").open()
 
     def remove_client(self, address): # remove client from list if it is present
         for idx, entry in enumerate(self.clients_list):
@@ -112,8 +116,7 @@ class ServerScreen(Screen, MyScreen):
             ErrorPopup("Server closed", "Your server was closed bacause you exceeded connection time.").open()
             self.reset()
 
-        while len(self.actions):
-            name, data = self.actions.pop(0)
+        for name, data in self.actions.take():
             match name:
                 case "REMOVE":
                     self.remove_client(data)
@@ -154,11 +157,12 @@ class ClientScreen(Screen, MyScreen):
             if self.join is not None:
                 self.join.dismiss()
         else:
+            from client import Client
             self.client = Client()
             self.join = None
         self.dots = 0
         self.servers_list = []
-        self.actions = [] # each action must be O(1)
+        self.actions = ActionQueue()
 
     def initialize(self, client_name):
         self.reset()
@@ -167,9 +171,19 @@ class ClientScreen(Screen, MyScreen):
 
     def add_server(self, server_name, server_address): # add server name to be displayed on list
         self.servers_list.append({
-            "text": server_name, "address": server_address, "root": self
+            "text": server_name, "name": server_name, "address": server_address, "root": self
         })
 
+    def update_server(self, server_address, **changes): # name shown in the list says if he plays and his round trip
+        for idx, entry in enumerate(self.servers_list):
+            if entry["address"] == server_address:
+                entry = {**entry, **changes}
+                text = entry["name"] + (" (watch)" if entry.get("busy") else "")
+                if entry.get("rtt") is not None:
+                    text += f"  {entry['rtt']:.0f} ms"
+                self.servers_list[idx] = {**entry, "text": text}
+                return
+
     def remove_server(self, server_address): # remove server from the list if present
         for idx, entry in enumerate(self.servers_list):
             if entry["address"] == server_address:
@@ -179,13 +193,19 @@ class ClientScreen(Screen, MyScreen):
     def tick(self, *dt):
         self.dots = (self.dots + 1) % 4
 
-        while len(self.actions):
-            name, data = self.actions.pop(0)
+        for name, data in self.actions.take():
             match name:
                 case "REMOVE":
                     self.remove_server(data)
                 case "ADD":
                     self.add_server(*data)
+                case "BUSY": # server plays, offer watching instead
+                    self.update_server(data, busy=True)
+                case "FREE": # announced server finished his game
+                    self.update_server(data, busy=False)
+                case "PING":
+                    address, rtt = data
+                    self.update_server(address, rtt=rtt)
                 case "STOP WAITING": # server we wait for is unavailable
                     self.join.back_up(False)
                     ErrorPopup(*data).open()
@@ -195,11 +215,15 @@ class ClientScreen(Screen, MyScreen):
                     self.manager.transition.duration = settings.transition_duration
                     self.manager.transition.direction = "up"
                     self.manager.current = "game"
-                    self.manager.current_screen.set_up("client", data)
+                    self.manager.current_screen.set_up("spectate" if data.spectating else "client", data)
 
     def handler(self, server_name, server_address): # called whan user wants to join a server
-        self.client.request_game(server_address) # send request to a server
-        self.join = JoinPopup(server_name, self) 
+        entry = next((entry for entry in self.servers_list if entry["address"] == server_address), {})
+        if entry.get("busy"):
+            self.client.spectate(server_address) # ask to watch his game
+        else:
+            self.client.request_game(server_address) # send request to a server
+        self.join = JoinPopup(entry.get("name", server_name), self) 
         self.join.open()
         
 
@@ -207,6 +231,8 @@ class SettingsScreen(Screen, MyScreen):
     def validate(self): # check if data provied are in correct format and range
         settings.verbose = self.log.active
         settings.debug = self.debug.active
+        settings.announce = self.announce.active
+        settings.profile = self.profile.active
 
         try:
             fps = int(self.fps.text)
@@ -218,6 +244,16 @@ class SettingsScreen(Screen, MyScreen):
             self.fps.hint_text = str(fps)
         self.fps.text = ""
 
+        try:
+            tick_rate = int(self.tick_rate.text)
+            tick_rate = min(max(tick_rate, 1), 600)
+        except:
+            pass
+        else:
+            settings.tick_rate = tick_rate
+            self.tick_rate.hint_text = str(tick_rate)
+        self.tick_rate.text = ""
+
         fields = [self.latency, self.bot, self.user, self.ball, self.rounds]
         targets = []
         for idx in range(len(fields)):
@@ -271,92 +307,183 @@ class GameScreen(Screen, MyScreen, EventManager):
     streak = NumericProperty(0)
     cc = BooleanProperty(False)
     gg = BooleanProperty(False)
+    profiling = BooleanProperty(False)
+    profile_text = StringProperty("")
+    networking = BooleanProperty(False)
+    link_text = StringProperty("")
 
     def __init__(self, **kwargs):
         super(GameScreen, self).__init__(**kwargs)
+        self.engine = PongEngine() # holds whole game state, this screen only renders it
+        self.interpolation = SnapshotBuffer() # client's view of the server's snapshots
+        self.predictor = PaddlePredictor()
+        self.inputs = InputStream() # server's view of client's inputs
+        self.recorder = None
+        self.profiler = FrameProfiler()
+        self.rendered = {}
+
+    def on_size(self, *args): # engine works in screen heights, so only aspect ratio matters
+        if self.height > 0:
+            self.engine.resize(self.width / self.height)
+            if self.recorder is not None:
+                self.recorder.event("RESIZE", self.engine.state.width)
 
     def reset(self, initial=False):
         settings.inform(f"Resetting the game ({initial}).")
         if initial:
             self.keyboard = Window.request_keyboard(None, self)
-            self.ticking = self.counting = self.serving = None
+            self.ticking = self.counting = self.serving = self.linking = None
         else:
-            for player in self.players: 
-                player.score = 0
-            for event in [self.ticking, self.counting, self.serving]:
+            for event in [self.ticking, self.counting, self.serving, self.linking]:
                 if event is not None:
                     event.cancel()
             self.keyboard.unbind(on_key_down=self.on_key_down, on_key_up=self.on_key_up)
-
-        self.reset_players()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if not initial and self.profiler.frames:
+            settings.inform(f"Frame profile saved to {self.profiler.dump(self.opt)}")
+        Window.unbind(on_draw=self.profiler.draw_started, on_flip=self.profiler.draw_ended)
+        self.profiler = FrameProfiler()
+
+        self.engine.reset()
+        self.interpolation.clear()
+        self.predictor.clear()
+        self.inputs = InputStream()
         self.started = self.ended = False
-        self.cc = self.gg = False # marks if countdown or turn is active
-        self.cache_streak = self.streak = 0
+        self.cache_streak = 0
         self.internet = self.target = None # client or server handling connections 
-        self.actions = [] # all must be O(1)
+        self.actions = ActionQueue()
+        self.rendered = {} # key -> value last assigned to widgets, cleared so everything is drawn again
+        self.render()
 
     def set_up(self, opt, internet=None):
         self.reset(True)
         settings.inform(f"Setting up a game: {opt}")
         self.opt = opt
         self.internet = internet
+        if opt in ["client", "spectate"]: # snapshots are whole states, stale ones only make us lag behind
+            self.actions.coalesce("UPDATE")
+        seed = getrandbits(63) # match can be played again from its seed and inputs
+        self.random = Random(seed)
+        self.bot = Bot(seed)
+        if settings.record and opt in ["server", "offline", "solo"]:
+            self.recorder = Recorder(path_for(opt), seed)
+        self.profiler = FrameProfiler(settings.profile, 1 / settings.fps, settings.profile_window)
+        if settings.profile:
+            Window.bind(on_draw=self.profiler.draw_started, on_flip=self.profiler.draw_ended)
+        self.profiling = settings.profile
+        self.profile_text = ""
+        self.networking = internet is not None
+        self.link_text = ""
+        state = self.engine.state
+        state.player1.speed = state.player2.speed = settings.moveSpeed
 
         match opt:
             case "solo":
-                self.player1.move = Bot.move
+                state.player1.speed = settings.botMoveSpeed
                 self.player1.name = "Bot"
                 self.player2.name = "You"
             case "offline":
-                self.player1.move = Paddle.move
                 self.player1.name = "Player 1"
                 self.player2.name = "Player 2"
             case "server":
-                self.player1.move = Paddle.move
                 self.internet.screen = self
                 self.player1.name = internet.client_name
                 self.player2.name = internet.server_name
             case "client":
-                self.player1.move = Paddle.move
                 self.internet.screen = self
                 self.player1.name = internet.server_name
                 self.player2.name = internet.client_name
+            case "spectate": # we see the game as the client does
+                self.internet.screen = self
+                self.player1.name = internet.server_name
+                self.player2.name = internet.player_name
 
         self.keyboard.bind(on_key_down=self.on_key_down, on_key_up=self.on_key_up)
         self.ticking = Clock.schedule_interval(self.tick, 1. / settings.fps) # administrates all game dependencies
+        if self.networking: # link statistics change once a second
+            self.linking = Clock.schedule_interval(self.show_link, 1)
         if self.opt in ["server", "offline", "solo"]: # if this computer calculates game events
             self.start()
 
     def tick(self, *dt):
+        profiler = self.profiler
+        profiler.begin()
         permission = self.handle_actions() # permission will be False in case of leaving
         if permission:
+            profiler.mark("actions")
             self.handle_game_action() 
+            profiler.mark("game")
             self.send_data()
+            profiler.mark("send")
+            if self.opt in ["client", "spectate"]:
+                self.interpolate()
+                profiler.mark("interpolate")
+            self.render()
+            profiler.mark("sync_widgets") # only assigns widget properties, canvas is drawn later ("draw")
+            profiler.end()
+            if self.profiling and profiler.frames % max(settings.fps // 2, 1) == 0: # overlay text is costly, refresh it twice a second
+                self.profile_text = profiler.report()
+
+    def show_link(self, *dt):
+        self.link_text = self.internet.link.summary()
+
+    def render(self): # copy engine state into widgets, only values that changed since the last frame are assigned
+        state = self.engine.state
+        scale = self.height
+        changed = self.changed
+        if changed("flags", (state.gg, state.cc, state.streak)):
+            self.gg = state.gg
+            self.cc = state.cc
+            self.streak = state.streak
+
+        for index, (widget, paddle) in enumerate(zip(self.players, state.players)):
+            y = paddle.y * scale
+            if changed(("y", index), y):
+                widget.y = y
+            if changed(("score", index), paddle.score): # score labels are rebuilt on every change
+                widget.score = paddle.score
+            if changed(("scored", index), paddle.scored):
+                widget.color = "green" if paddle.scored else "white"
+        pos = (state.ball.x * scale, state.ball.y * scale)
+        if changed("ball", pos):
+            self.ball.pos = pos
+
+    def changed(self, key, value): # every assignment dispatches kivy observers, so remember what was rendered
+        if key in self.rendered and self.rendered[key] == value:
+            return False
+        self.rendered[key] = value
+        return True
         
     def start_countdown(self, callback, callback_data, duration):
-        if not self.cc: # if it wasn't paused during another countdown
-            self.cache_streak = self.streak
-        self.cc = True
-        self.streak = duration
+        state = self.engine.state
+        if not state.cc: # if it wasn't paused during another countdown
+            self.cache_streak = state.streak
+        state.cc = True
+        state.streak = duration
         self.counting = Clock.schedule_interval(partial(self.countdown, callback, callback_data), 1)
 
     def countdown(self, callback, callback_data, *dt):
-        if self.streak == 0: # countdown timeout
+        state = self.engine.state
+        if state.streak == 0: # countdown timeout
             self.counting.cancel()
-            self.streak = self.cache_streak
-            self.cc = False # mark countdown as finished
+            state.streak = self.cache_streak
+            state.cc = False # mark countdown as finished
             callback(*callback_data)
         else:
-            self.streak -= 1
+            state.streak -= 1
 
     def start(self):
-        self.ball.center = self.center
-        self.start_countdown(self.serve, [choice([-1, 1])], settings.time_to_start)
+        self.engine.center_ball()
+        self.start_countdown(self.serve, [self.random.choice([-1, 1])], settings.time_to_start)
 
     def pause(self):
-        if self.gg: # if during round
-            self.gg = False
-        elif self.cc: # if during countdown
-            self.cc = False
+        state = self.engine.state
+        if state.gg: # if during round
+            state.gg = False
+        elif state.cc: # if during countdown
+            state.cc = False
             self.counting.cancel()
         elif self.serving is not None: # if serving a ball might be scheduled
             self.serving.cancel()
@@ -368,57 +495,75 @@ class GameScreen(Screen, MyScreen, EventManager):
             self.start_countdown(self.unpause_helper, [], settings.time_to_unpause)
 
     def unpause_helper(self):
-        self.streak = self.cache_streak
-        self.gg = True # mark turn started
-        print(self.target)
+        state = self.engine.state
+        state.streak = self.cache_streak
+        state.gg = True # mark turn started
         if self.target is not None and self.target[0] == "serve":
             self.serve(*self.target[1:])
         self.target = None # reset target call
         
     def serve(self, direction, *dt):
         settings.inform(f"Serving a ball (direction -> {direction})")
-        self.reset_players()
         self.started = True
-        self.gg = True
         self.target = None # serve was done
-        self.ball.center = self.center
-        self.ball.velocity = Vector(direction * self.height * settings.speed, 0).rotate(randint(-60, 60))
-
-    def turn_end(self, winner, direction):
-        settings.inform(f"Turn ended. ({winner.name} has won)")
-        self.gg = False # mark turn end
-        self.streak = 0 # reset streak
-        self.ball.center = self.center # pause now won't take twice the same turn end
-        winner.reward()
-
-        if self.player1.score == settings.rounds_to_win:
-            self.end_game(self.player1)
-            return
-        elif self.player2.score == settings.rounds_to_win:
-            self.end_game(self.player2)
+        angle = self.random.randint(-60, 60)
+        self.engine.serve(direction, angle)
+        self.bot.reset()
+        if self.recorder is not None:
+            self.recorder.event("SERVE", [direction, angle])
+
+    def turn_end(self, scorer, direction): # scorer is 1 or 2
+        settings.inform(f"Turn ended. ({self.players[scorer - 1].name} has won)")
+        self.engine.end_turn(scorer)
+
+        winner = self.engine.winner()
+        if winner:
+            self.end_game(winner)
             return
 
         self.target = ("serve", direction)  # during turn end mark that we need to call serve again in case of pause right now
         self.serving = Clock.schedule_once(partial(self.serve, direction), 1) # start next turn after 1 s so player could prepare
 
-    def end_game(self, winner):
-        if winner == self.player2: # we won
+    def end_game(self, winner): # winner is 1 or 2
+        state = self.engine.state
+        score1, score2 = state.player1.score, state.player2.score
+        if winner == 2: # we won
             if self.opt == "server": # send info to client
-                self.internet.event_dispatcher("GAME END", [False, self.player2.score, self.player1.score]) # again players reversed
+                self.dispatch("GAME END", [False, score2, score1]) # again players reversed
         else: # opponent won
             if self.opt == "server": # send info to client
-                self.internet.event_dispatcher("GAME END", [True, self.player2.score, self.player1.score])
-        self.end_game_helper(winner == self.player2, self.player1.score, self.player2.score)
+                self.dispatch("GAME END", [True, score2, score1])
+        self.end_game_helper(winner == 2, score1, score2)
 
     def end_game_helper(self, status, score1, score2, *dt):
         settings.inform(f"Game ended. ({status})")
         self.ended = True
-        if status: # status True if we won, False if the opponent won
+        if self.opt == "spectate": # status is from the point of view of player2
+            if status:
+                ErrorPopup("Game ended", f"{self.player2.name} WON against {self.player1.name} with score {score2} : {score1}.").open()
+            else:
+                ErrorPopup("Game ended", f"{self.player1.name} WON against {self.player2.name} with score {score1} : {score2}.").open()
+        elif status: # status True if we won, False if the opponent won
             ErrorPopup("Game ended", f"You WON against {self.player1.name} with score {score2} : {score1}.").open()
         else:
             ErrorPopup("Game ended", f"You LOST against {self.player1.name} with score {score2} : {score1}.").open()
         Clock.schedule_once(partial(self.add_action, "LEAVE", None), 0.5) # give time to send the final data
 
-    def reset_players(self, *dt): # set all players in starting positions and set their color to white
-        for player in self.players:
-            player.reset(self)
+
+class LazyScreenManager(ScreenManager): # screens are built the first time they are shown or asked for
+    def get_screen(self, name):
+        if not self.has_screen(name) and name in SCREENS:
+            self.add_widget(SCREENS[name](name=name))
+        return super(LazyScreenManager, self).get_screen(name)
+
+
+SCREENS = {
+    "menu": MenuScreen,
+    "connect": ConnectScreen,
+    "settings": SettingsScreen,
+    "name": NameScreen,
+    "server": ServerScreen,
+    "client": ClientScreen,
+    "game": GameScreen,
+    "pause": PauseScreen,
+}
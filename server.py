@@ -1,14 +1,18 @@
 from _thread import *
 import time
 import socket
+import selectors
 
 from settings import *
 from internet import Internet
+from netcode import Spectator, LinkStats
+import protocol
 
 
 class Server(Internet):
     def __init__(self):
         self.type_ = "server"
+        self.outgoing = protocol.STATE # opcode of game frames we send
         self.reset(True)
 
     def reset(self, initial=False):
@@ -20,6 +24,8 @@ class Server(Internet):
                 self.shutdown(self.socket_)
 
         self.clients = set()
+        self.spectators = set() # connections watching our game
+        self.spectator_snapshots = protocol.SnapshotEncoder() # never acknowledged, so every frame is a keyframe
         self.client_address = None
         self.client_name = ""
         self.server_name = ""
@@ -44,6 +50,12 @@ class Server(Internet):
             except Exception as e:
                 settings.handle_error(e)
             else:
+                if settings.announce:
+                    if settings.multicast():
+                        socket_.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1) # stay in LAN
+                        socket_.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(settings.HOST))
+                    else:
+                        socket_.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
                 self.socket_ = socket_
                 self.address = address
                 self.working = True
@@ -78,84 +90,91 @@ class Server(Internet):
                         self.screen.accept.back_up()
         self.shutdown(socket_)
 
-    def listen_client(self, socket_, address, t0):
+    # handles one client's packet (or his silence if data is empty), returns None to keep the connection
+    # or whether connection_error should be called when it has to be closed
+    def handle_client(self, connection, data, t1):
+        address = connection.address
+        is_client = self.client_address == address
         def send(data):
-            self.send(socket_, data, address)
+            self.send(connection.socket_, data, address)
+
+        timeout = settings.connection_timeout if self.playing and is_client else settings.lobby_timeout()
+        if t1 - connection.t0 > timeout:
+            settings.inform(f"Connection timeout ({address}).")
+            return True
+
+        if data == LEAVE:
+            settings.inform(f"Client left.")
+            return True
+
+        elif data == ABANDON:
+            settings.inform(f"Client {address} aborted.")
+            self.spectators.discard(connection)
+            self.screen.add_action("REMOVE", address)
+            send(REQUEST_RECIVED)
+            
+            if self.playing and is_client:
+                self.screen.add_action("ERROR", ("Client lost", "Player left the game."))
+                self.screen.add_action("LEAVE", None)
+            elif self.screen.accept is not None and self.screen.accept.client_address == address: # if accept popup to that client was open
+                self.screen.add_action("ERROR", ("Client resigned", "That user is not longer interested."))
+                self.client_address = None
+
+        elif self.abandon_ and self.playing and is_client:
+            settings.inform(f"Abandoning the game with {address}.")
+            send(ABANDON)
+            self.screen.add_action("LEAVE", None)
+            return False
+
+        elif self.playing and is_client:
+            self.internet_action(data, send)
         
-        refresh = settings.server_frequency
-        while self.working: 
-            is_client = self.client_address == address
-            t1 = time.time()
+        elif connection in self.spectators: # his frames only acknowledge what he got
+            pass
 
-            if t1 - t0 > settings.connection_timeout:
-                settings.inform(f"Connection timeout ({address}).")
-                break # will call connecion_error
-                     
-            data = self.data_recive(socket_)
+        elif self.playing and data == WATCH:
+            settings.inform(f"Client {address} watches the game.")
+            connection.snapshots = Spectator()
+            connection.link = LinkStats(f"Spectator {address}") # only his acknowledgements, watched frames are shared
+            connection.socket_.setblocking(False) # slow spectator can't hold up the game
+            self.spectators.add(connection)
+            send({"opponent": self.client_name, **WATCHING})
 
-            if data == LEAVE:
-                settings.inform(f"Client left.")
-                break # will call connecion_error
+        elif self.playing and not is_client and data: # he can only watch, answered only when he asks (not on idle polls)
+            send(BUSY)
 
-            elif data == ABANDON:
-                settings.inform(f"Client {address} aborted.")
-                self.screen.add_action("REMOVE", address)
-                send(REQUEST_RECIVED)
-                
-                if self.playing and is_client:
-                    self.screen.add_action("ERROR", ("Client lost", "Player left the game."))
-                    self.screen.add_action("LEAVE", None)
-                elif self.screen.accept is not None and self.screen.accept.client_address == address: # if accept popup to that client was open
-                    self.screen.add_action("ERROR", ("Client resigned", "That user is not longer interested."))
-                    self.client_address = None
+        elif data == ALIVE: # he tells us that he is still here
+            settings.inform(f"Connection with client {address} renewed.")
+            send({"server_name": self.server_name, **REQUEST_RECIVED})
 
-            elif self.abandon_ and self.playing and is_client:
-                settings.inform(f"Abandoning the game with {address}.")
-                send(ABANDON)
-                self.screen.add_action("LEAVE", None)
-                return
+        elif data == WAITING:
+            if self.accept and is_client: # accepting the game
+                settings.inform(f"Game with {address} started.")
+                send(GAME_ACCEPTED)
+            else: # renew connection
+                settings.inform(f"Client {address} is still waiting to join.")
+                send(REQUEST_RECIVED)
 
-            elif self.playing and is_client:
-                self.internet_action(data, send)
+        elif self.accept and data == GAME_START: # client is ready for a game
+            settings.inform(f"Starting the game with {address}")
+            self.client_name = connection.client_name
+            self.playing = True
+            self.accept = False
+            self.screen.add_action("START", self)
             
-            elif self.playing and not is_client: # send him bey bey
-                send(BUSY)
-                # at this point we are playing, no need to delete anything
-                return
-
-            elif data == ALIVE: # he tells us that he is still here
-                settings.inform(f"Connection with client {address} renewed.")
-                send({"server_name": self.server_name, **REQUEST_RECIVED})
-
-            elif data == WAITING:
-                if self.accept and is_client: # accepting the game
-                    settings.inform(f"Game with {address} started.")
-                    send(GAME_ACCEPTED)
-                else: # renew connection
-                    settings.inform(f"Client {address} is still waiting to join.")
-                    send(REQUEST_RECIVED)
-   
-            elif self.accept and data == GAME_START: # client is ready for a game
-                settings.inform(f"Starting the game with {address}")
-                self.client_name = client_name
-                refresh = settings.server_time_refresh
-                self.playing = True
-                self.accept = False
-                self.screen.add_action("START", self)
-                
-            elif "client_name" in data:
-                client_name = data.pop("client_name")
-
-                if data == REQUEST_GAME:
-                    settings.inform(f"Client {address} wants to join a game.")
-                    send(REQUEST_RECIVED)
-                    self.screen.add_action("ADD", (client_name, address))
+        elif "client_name" in data:
+            client_name = data.pop("client_name")
 
-            if data:  # there was an interaction with client, reset timer
-                t0 = t1
-            time.sleep(refresh)
+            if data == REQUEST_GAME:
+                settings.inform(f"Client {address} wants to join a game.")
+                connection.client_name = client_name
+                send(REQUEST_RECIVED)
+                self.screen.add_action("ADD", (client_name, address))
 
-        self.connection_error(is_client, address, socket_)
+        if data:  # there was an interaction with client, reset timer
+            connection.t0 = t1
+        connection.polled = t1
+        return None
 
     def get_new_socket(self): # get first free socket on this pc
         port = 2000
@@ -174,20 +193,122 @@ class Server(Internet):
             else:
                 port += 1
 
+    def new_client(self, selector, connections, address):
+        new_socket_, new_address = self.get_new_socket()
+        
+        response = {
+            "server_name": self.server_name,
+            "address": new_address,
+            **REQUEST_RECIVED
+        }
+        self.send(self.socket_, response, address)
+        settings.inform(f"New connection from {address}.")
+        self.clients.add(address)
+
+        connection = Connection(new_socket_, address, time.time())
+        connections[address] = connection
+        selector.register(new_socket_, selectors.EVENT_READ, connection)
+        return connection
+
+    # single loop multiplexing the lobby socket and all clients' dedicated sockets
     def listen(self):
-        while self.working:
-            data, address = self.recive(self.socket_)
-            if data == ALIVE and address not in self.clients: # if we found new connection from identified client
-                new_socket_, new_address = self.get_new_socket()
-                
-                response = {
-                    "server_name": self.server_name,
-                    "address": new_address,
-                    **REQUEST_RECIVED
-                }
-                self.send(self.socket_, response, address)
-                settings.inform(f"New connection from {address}.")
-                self.clients.add(address)
-                start_new_thread(self.listen_client, (new_socket_, address, time.time()))
-
-            time.sleep(settings.server_frequency)
+        main_socket_ = self.socket_
+        selector = selectors.DefaultSelector()
+        selector.register(main_socket_, selectors.EVENT_READ, None)
+        selector.register(self.wakeup, selectors.EVENT_READ, self) # game thread has events to send
+        connections = {} # client address -> Connection
+        next_announce = time.time()
+
+        timeout = settings.socket_timeout
+        while self.working and self.socket_ is main_socket_: # stop as well if server was reset and set up again
+            try:
+                events = selector.select(timeout)
+            except Exception as e: # main socket was closed
+                settings.handle_error(e)
+                break
+            t1 = time.time()
+
+            ready = {} # client address -> (connection, data)
+            for key, _ in events:
+                if key.data is self:
+                    self.drain_wakeup()
+                elif key.data is None: # lobby socket
+                    data, address = self.recive(main_socket_)
+                    if data == ALIVE and address not in self.clients: # if we found new connection from identified client
+                        self.new_client(selector, connections, address)
+                    elif data == DISCOVER: # client seeks servers, he can watch us if we play
+                        self.send(main_socket_, {"server_name": self.server_name, **REQUEST_RECIVED}, address)
+                else:
+                    ready[key.data.address] = (key.data, self.data_recive(key.data.socket_, key.data.snapshots, key.data.link))
+
+            # clients that were silent for a while are handled as after an empty receive
+            for address, connection in connections.items():
+                if address not in ready and self.due(connection, t1):
+                    ready[address] = (connection, {})
+
+            for connection, data in ready.values():
+                status = self.handle_client(connection, data, t1)
+                if status is not None:
+                    self.close_client(selector, connections, connection, status)
+
+            if settings.announce and t1 >= next_announce:
+                self.announce(main_socket_)
+                next_announce = t1 + settings.announce_interval
+            timeout = self.service(t1)
+
+        for connection in list(connections.values()):
+            self.close_client(selector, connections, connection, True)
+        selector.close()
+
+    def due(self, connection, t1): # connection has to be handled even without a packet
+        if self.playing and connection.address == self.client_address and (t1 >= self.next_send or self.data): # game frame to send
+            return True
+        return t1 - connection.polled >= settings.socket_timeout
+
+    def service(self, t1): # work done on every loop, returns the longest time loop may wait for packets
+        if self.playing:
+            return min(settings.socket_timeout, max(self.next_send - t1, 0))
+        return settings.socket_timeout
+
+    def broadcast(self, events, update): # frame is encoded once and the same bytes go to every spectator
+        if not self.spectators:
+            return
+        frame = protocol.encode(protocol.STATE, events, update, self.spectator_snapshots)
+        seq = self.spectator_snapshots.seq
+        for connection in self.spectators:
+            spectator = connection.snapshots
+            if spectator.wants(seq) or events: # events must not be skipped
+                try:
+                    connection.socket_.sendto(frame, connection.address)
+                except BlockingIOError: # his buffer is full
+                    spectator.slow_down()
+                except Exception as e:
+                    settings.handle_error(e)
+
+    def announce(self, socket_): # let listening clients know about us, answers come to the lobby socket as usual
+        data = {"announce": self.server_name, "port": self.address[1], "free": not self.playing}
+        self.send(socket_, data, (settings.announce_address, settings.announce_port))
+
+    def close_client(self, selector, connections, connection, error):
+        del connections[connection.address]
+        self.spectators.discard(connection)
+        selector.unregister(connection.socket_)
+        if error:
+            self.connection_error(self.client_address == connection.address, connection.address, connection.socket_)
+        else:
+            self.shutdown(connection.socket_)
+
+
+class Connection: # one client's dedicated socket, served by Server.listen
+    __slots__ = ("socket_", "address", "t0", "polled", "client_name", "snapshots", "link", "room", "slot")
+
+    def __init__(self, socket_, address, t0):
+        self.socket_ = socket_
+        self.address = address
+        self.t0 = t0 # time of the last interaction
+        self.polled = t0 # time of the last handling
+        self.client_name = ""
+        self.snapshots = None # own snapshots encoder, if server plays more games (None uses server's one)
+        self.link = None # own LinkStats, goes with own snapshots
+        self.room = None # used by rooms.RoomServer
+        self.slot = 0
@@ -1,4 +1,5 @@
 import socket
+from threading import Thread
 
 class Settings():
     fps = 60
@@ -6,17 +7,28 @@ class Settings():
     speedup = 1.05 # ball speeds up every time it bounce off paddle
     moveSpeed = 0.015 # paddle move speed
     botMoveSpeed = 0.004 # bot is slower than real player
+    bot_reaction = 0.2 # seconds before bot notices that the ball has changed direction
+    bot_error = 0.1 # bot misses the spot where the ball comes by up to that much (in screen heights)
     startPaddleSize = 0.3
     rounds_to_win = 10
     time_to_start = 5
     time_to_unpause = 3
 
     transition_duration = 1.5
+    actions_per_tick = 32 # network actions game screen handles in one frame, rest waits for the next one
 
     PORT = 8000
     MAX_PORT = 8001
-    HOST = socket.gethostbyname(socket.gethostname())
+    host = None # this PC's LAN address, looked up in the background (see HOST)
+    resolving = None # thread of the lookup
+    host_timeout = 3 # seconds HOST waits for the lookup before it falls back to loopback
+    host_fallback = False # lookup didn't finish in time and loopback is used for good, LAN players can't reach us
     conn_data_limit = 1024
+    announce = False # servers announce themselves and clients listen for them instead of scanning the network
+    announce_address = "<broadcast>" # or a multicast group, like "239.255.80.78"
+    announce_port = 8010
+    announce_interval = 1
+    announce_timeout = 3 # seconds since his last announcement after which a server is taken off the list
     encoding = "utf-8"
     key = "7fZmv`UXa75@K7e$3+g@"
 
@@ -28,6 +40,23 @@ class Settings():
 
     server_frequency = 1 # waiting time between server loops in ms for rest
     server_time_refresh = 0 # waiting time between server loops in ms for players
+    tick_rate = 30 # game frames sent per second by both sides, independent of fps
+    keyframe_interval = 60 # every n-th game state snapshot is sent whole
+    snapshot_history = 32 # number of sent snapshots client can acknowledge and get deltas against
+    interpolation_delay = 0.1 # client draws remote ball and paddle that many seconds in the past
+    interpolation_snap = 0.25 # bigger jump between snapshots (in screen heights) is not interpolated
+    input_history = 16 # client's last inputs repeated in every packet
+    input_buffer = 8 # inputs server keeps ahead before it skips the oldest ones
+    stats_interval = 5 # seconds between connection statistics in the log
+    spectator_lag = 0.5 # seconds spectator's acknowledgements may fall behind before he gets fewer frames
+
+    record = False # computing side saves every match into record_dir (see recording.py)
+    record_dir = "recordings"
+    record_keyframe_interval = 60 # ticks between whole states in a recording
+
+    profile = False # game screen times its frames, shows them and saves them into profile_dir when game ends
+    profile_dir = "profiles"
+    profile_window = 600 # frames the percentiles are computed from
 
     debug = False
     verbose = False
@@ -40,6 +69,50 @@ class Settings():
         if self.verbose:
             print(msg)
 
+    # name lookup can block for seconds with broken DNS, so it starts with the app and only waits when HOST is needed
+    def resolve_host(self):
+        if self.host is None and self.resolving is None:
+            self.resolving = Thread(target=self.lookup_host, daemon=True)
+            self.resolving.start()
+
+    def lookup_host(self):
+        try:
+            host = socket.gethostbyname(socket.gethostname())
+        except OSError as e:
+            self.handle_error(e)
+            self.fall_back()
+        else:
+            if self.host is None: # unless it was set meanwhile
+                self.host = host
+
+    def fall_back(self): # decided once so every socket binds to the same address, ServerScreen warns the user
+        if self.host is None:
+            self.host = "127.0.0.1"
+            self.host_fallback = True
+            self.inform(f"LAN address not found, using {self.host}, only this PC can connect.")
+
+    @property
+    def HOST(self):
+        if self.host is None:
+            self.resolve_host()
+            self.resolving.join(self.host_timeout)
+            self.fall_back() # lookup hangs
+        return self.host
+
+    @HOST.setter
+    def HOST(self, host):
+        self.host = host
+        self.host_fallback = False
+
+    def lobby_timeout(self): # lobby packets come only every server_frequency, so silence may last that much longer
+        return self.connection_timeout + self.server_frequency
+
+    def multicast(self): # announcements go to a multicast group rather than broadcast
+        try:
+            return 224 <= int(self.announce_address.split(".")[0]) <= 239
+        except ValueError:
+            return False
+
     def allowed(self, address):
         if address:
             return address[0] == self.HOST and self.PORT <= address[1] <= self.MAX_PORT
@@ -54,6 +127,8 @@ all = {
 }
 
 ALIVE = {"free": None,}
+DISCOVER = {"discover": True,} # asks for server's name without opening a connection
+ANNOUNCE = {"announce": None, "port": None, "free": None,} # keys of server's periodic announcement
 LEAVE = {"left": True,}
 
 WAITING = {"waiting": True,}
@@ -63,4 +138,7 @@ BUSY = {"allowed": False,}
 ABANDON = {"bye": True,}
 
 GAME_ACCEPTED = {"allowed": True,}
-GAME_START = {"start": True,}
\ No newline at end of file
+GAME_START = {"start": True,}
+
+WATCH = {"watch": True,} # asks a playing server to spectate its game
+WATCHING = {"watching": True,}
\ No newline at end of file
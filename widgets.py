@@ -1,6 +1,5 @@
 from kivy.uix.widget import Widget
-from kivy.properties import NumericProperty, ReferenceListProperty, ColorProperty, StringProperty, BooleanProperty, ObjectProperty
-from kivy.vector import Vector
+from kivy.properties import NumericProperty, ColorProperty, StringProperty, BooleanProperty, ObjectProperty
 from kivy.uix.popup import Popup
 from kivy.uix.button import Button
 from kivy.core.window import Window
@@ -9,6 +8,113 @@ from kivy.clock import Clock
 from settings import settings
 
 
+# single Window.mouse_pos listener for all HoverableButtons, hit tests only mounted ones through a grid of their window boxes
+# grid is rebuilt on the next mouse move after a button or any of its parents moved, resized, scrolled or got (de)attached
+class HoverManager:
+    cell = 64 # grid cell size in pixels
+    watched_properties = ("pos", "size", "parent", "scroll_x", "scroll_y")
+
+    def __init__(self):
+        self.buttons = {} # mounted button -> its parents being watched
+        self.watched = {} # parent -> number of mounted buttons below it
+        self.boxes = {} # button -> (left, bottom, right, top) in window coordinates, only buttons that are displayed
+        self.grid = {} # (column, row) -> buttons whose box overlaps that cell
+        self.hovered = set()
+        self.dirty = False
+
+    def invalidate(self, *args):
+        self.dirty = True
+
+    def bind(self, widget, bind):
+        for name in self.watched_properties:
+            if name in widget.properties():
+                (widget.fbind if bind else widget.funbind)(name, self.invalidate)
+
+    def watch(self, parents, change): # change is 1 for start, -1 for stop watching
+        for parent in parents:
+            count = self.watched.get(parent, 0) + change
+            if count <= 0:
+                self.watched.pop(parent, None)
+                self.bind(parent, False)
+            else:
+                if count == 1 and change > 0:
+                    self.bind(parent, True)
+                self.watched[parent] = count
+
+    @staticmethod
+    def parents(widget):
+        parents = []
+        widget = widget.parent
+        while isinstance(widget, Widget):
+            parents.append(widget)
+            widget = widget.parent
+        return tuple(parents)
+
+    def mount(self, button):
+        if button in self.buttons:
+            return
+        if not self.buttons:
+            Window.bind(mouse_pos=self.on_mouse_pos, size=self.invalidate)
+        parents = self.parents(button)
+        self.buttons[button] = parents
+        self.watch(parents, 1)
+        self.bind(button, True)
+        self.dirty = True
+
+    def unmount(self, button):
+        if button not in self.buttons:
+            return
+        self.watch(self.buttons.pop(button), -1)
+        self.bind(button, False)
+        self.leave(button)
+        self.dirty = True
+        if not self.buttons:
+            Window.unbind(mouse_pos=self.on_mouse_pos, size=self.invalidate)
+
+    def rebuild(self):
+        self.dirty = False
+        self.boxes.clear()
+        self.grid.clear()
+        for button, parents in self.buttons.items():
+            current = self.parents(button)
+            if current != parents: # button was moved inside the tree, watch its new parents
+                self.watch(current, 1)
+                self.watch(parents, -1)
+                self.buttons[button] = current
+            if not button.get_root_window(): # not displayed, like buttons of other screens
+                continue
+            left, bottom = button.to_window(button.x, button.y)
+            right, top = button.to_window(button.right, button.top)
+            self.boxes[button] = (left, bottom, right, top)
+            for column in range(int(left // self.cell), int(right // self.cell) + 1):
+                for row in range(int(bottom // self.cell), int(top // self.cell) + 1):
+                    self.grid.setdefault((column, row), []).append(button)
+
+    def on_mouse_pos(self, window, pos):
+        if self.dirty:
+            self.rebuild()
+        x, y = pos
+        inside = set()
+        for button in self.grid.get((int(x // self.cell), int(y // self.cell)), ()):
+            left, bottom, right, top = self.boxes[button]
+            if left <= x <= right and bottom <= y <= top:
+                inside.add(button)
+
+        for button in self.hovered - inside:
+            self.leave(button)
+        for button in inside - self.hovered:
+            self.hovered.add(button)
+            button.border_point = pos
+            button.hovered = True
+            button.dispatch("on_enter")
+
+    def leave(self, button):
+        if button in self.hovered:
+            self.hovered.discard(button)
+            button.hovered = False
+            button.dispatch("on_leave")
+
+
 class HoverableButton(Button):
     hovered = BooleanProperty(False)
     border_point= ObjectProperty(None)
@@ -17,23 +123,12 @@ class HoverableButton(Button):
         super(HoverableButton, self).__init__(**kwargs)
         self.register_event_type('on_enter')
         self.register_event_type('on_leave')
-        Window.bind(mouse_pos=self.on_mouse_pos)
-
-    def on_mouse_pos(self, *args):
-        if not self.get_root_window():
-            return # do proceed if I'm not displayed <=> If have no parent
-        pos = args[1]
-        # Next line to_widget allow to compensate for relative layout
-        inside = self.collide_point(*self.to_widget(*pos))
-        if self.hovered == inside:
-            # We have already done what was needed
-            return
-        self.border_point = pos
-        self.hovered = inside
-        if inside:
-            self.dispatch('on_enter')
+
+    def on_parent(self, widget, parent): # only buttons in the widget tree are hit tested
+        if parent is None:
+            hover.unmount(self)
         else:
-            self.dispatch('on_leave')
+            hover.mount(self)
 
     def on_enter(self): # change color to red if mouse above us
         self.color = "red"
@@ -42,6 +137,9 @@ class HoverableButton(Button):
         self.color = "white"
 
 
+hover = HoverManager()
+
+
 class TickingPopup(Popup):
     exit_text = StringProperty("Back")
     title = StringProperty("Ticking Popup")
@@ -126,51 +224,14 @@ class ErrorPopup(Popup): # popup to inform user that doesn't provide any interac
         self.error = error
 
 
-class Paddle(Widget): 
+class Paddle(Widget): # view of engine.PaddleState
     score = NumericProperty(0)
     color = ColorProperty("white")
-    move_direction = NumericProperty(0)
     name = StringProperty("")
     bot = BooleanProperty(False)
-    
-    def bounce_ball(self, ball):
-        if self.collide_widget(ball):
-            velocity_x, velocity_y = ball.velocity
 
-            bounced = settings.speedup * Vector(-1 * velocity_x, velocity_y)
-            ball.velocity = bounced.x, bounced.y
-
-            return True
-        return False
-
-    def reward(self):
-        self.color = "green"
-        self.score += 1
-
-    def reset(self, root, *dt):
-        self.move_direction = 0 # stop moving
-        self.color = "white"
-        self.center_y = root.center_y
-
-    @staticmethod
-    def move(me, root):
-        if me.move_direction == 1: # up
-            new = me.top + settings.moveSpeed * root.height
-            me.top = min(new, root.top) # don't move out the screen
-        elif me.move_direction == -1: # down
-            new = me.y - settings.moveSpeed * root.height
-            me.y = max(new, root.y) # don't move out the screen
-
-
-class Ball(Widget):
-    velocity_x = NumericProperty(0)     
-    velocity_y = NumericProperty(0)    
-    velocity = ReferenceListProperty(velocity_x, velocity_y)
 
+class Ball(Widget): # view of engine.BallState
     def resize(self, _, newSize): # adjust size if window resized during game
         r = newSize[1] / 20
-        self.size = (r, r)    
-
-    def move(self): 
-        self.pos = Vector(*self.velocity) + self.pos
-
+        self.size = (r, r)